@@ -0,0 +1,1208 @@
+import os
+import time
+import sqlite3
+import tempfile
+import threading
+import numpy as np
+import h5py
+from collections import OrderedDict
+from prep_util import normalize_proj, reduce_frames, bin_proj
+from multiprocessing import Pool, cpu_count
+from concurrent.futures import ThreadPoolExecutor
+try:
+    import tifffile
+    exist_tifffile = True
+except:
+    exist_tifffile = False
+try:
+    import zarr
+    exist_zarr = True
+except:
+    exist_zarr = False
+
+
+class ProjBlockReader:
+    '''
+    Stream a projection file one detector-row block at a time.
+
+    Iterating over the reader yields (id_s, id_e, prj_norm), where id_s and id_e
+    are row indices relative to sli[0] and prj_norm is the flat/dark normalized
+    block with shape (n_angle, id_e - id_s, n_col). Only one block is held in
+    memory at a time, unless blocks were read ahead with prefetch().
+    Blocks of chunked (e.g. compressed) files are read by n_worker processes, see read_scan_parallel().
+    With angle_step > 1, only every angle_step-th projection is read (strided hyperslab), e.g. for a preview.
+    n_sli is the number of detector rows per block. If None, blocks hold recon_chunk_size() slices of a
+    reconstruction with the given binning.
+    With binning > 1, each block is read and normalized a group of angles at a time (about bin_read_bytes
+    at full resolution), and binned before the next group is read, so only binned data is kept: prj_norm is
+    (n_angle, (id_e - id_s) // binning, n_col // binning). Blocks with less than binning rows are skipped.
+    For a chunked dataset, the blocks follow its chunks, so each chunk is decompressed once: if one chunk spans
+    the whole row range (e.g. one chunk per frame), all blocks are filled in a single pass over the angles;
+    otherwise n_sli is rounded up to a multiple of the chunk height. What does not fit in stream_mem_frac of the
+    available memory falls back to the smallest chunk-aligned block, or else to n_sli rows per block, reading
+    (and decompressing) the chunks again for every block.
+    '''
+    def __init__(self, fn,
+                 attr_proj='img_tomo',
+                 attr_flat='img_bkg',
+                 attr_dark='img_dark',
+                 sli=[],
+                 dark_scale=1,
+                 n_sli=None,
+                 dtype=np.float32,
+                 n_worker=None,
+                 angle_step=1,
+                 binning=1,
+                 ):
+        self.fn = fn
+        self.attr_proj = attr_proj
+        self.attr_flat = attr_flat
+        self.attr_dark = attr_dark
+        self.dark_scale = dark_scale
+        self.binning = binning
+        self.dtype = dtype
+        self.n_worker = n_worker
+        self.angle_step = angle_step
+        with open_scan(fn) as hf:
+            ds = hf[attr_proj]
+            s = ds.shape
+            chunks = None if isinstance(h5_memmap(ds), np.memmap) else getattr(ds, 'chunks', None)
+        if len(sli) != 2:
+            sli = [0, s[1]]
+        # clamp to the rows of the dataset, like slicing the array would
+        r_s, r_e, _ = slice(int(sli[0]), int(sli[1])).indices(s[1])
+        self.sli = [r_s, max(r_s, r_e)]
+        self.n_angle = len(range(0, s[0], angle_step))
+        self.n_row = self.sli[1] - self.sli[0]
+        self.n_col = s[2]
+        if n_sli is None:
+            n_sli = recon_chunk_size(self.n_angle, self.n_row, self.n_col, binning, dtype) * binning
+        self.n_sli = int(n_sli)
+        self.one_pass = False
+        if chunks is not None and len(chunks) > 1 and chunks[1] > 1:
+            self.fit_chunks(chunks[1])
+        self.key = (os.path.abspath(fn), attr_proj, attr_flat, attr_dark, tuple(self.sli),
+                    float(dark_scale), self.n_sli, np.dtype(dtype).str, angle_step, binning)
+        self.skip_rows = set()
+        self.prefetched = {}
+        self.prefetch_thread = None
+        self.prefetch_stop = threading.Event()
+
+    def __len__(self):
+        return int(np.ceil(self.n_row / self.n_sli))
+
+    def __iter__(self):
+        self.stop_prefetch()
+        yield from self.read_blocks()
+
+    def fit_chunks(self, chunk_rows):
+        '''
+        choose how blocks are read from a dataset with chunks of chunk_rows rows, see the class doc
+        '''
+        if self.n_row == 0:
+            return
+        byte_per_row = self.n_angle * self.n_col * np.dtype(self.dtype).itemsize / self.binning**2
+        mem_limit = available_memory() * stream_mem_frac
+        if self.sli[0] // chunk_rows == (self.sli[1] - 1) // chunk_rows:
+            if self.n_row * byte_per_row <= mem_limit:
+                self.one_pass = True
+            return
+        step = int(np.lcm(chunk_rows, self.binning))
+        for n_sli in (int(np.ceil(self.n_sli / step)) * step, step):
+            if n_sli * byte_per_row <= mem_limit:
+                self.n_sli = n_sli
+                return
+
+    def read_blocks(self):
+        ref_flat, ref_dark = load_flat_dark(self.fn, self.attr_flat, self.attr_dark, self.dark_scale)
+        with open_scan(self.fn) as hf:
+            ds_proj = h5_memmap(hf[self.attr_proj])
+            blocks = []
+            for id_s in range(0, self.n_row, self.n_sli):
+                id_e = min(id_s + self.n_sli, self.n_row)
+                if id_s in self.skip_rows:  # e.g. already reconstructed in a previous run
+                    continue
+                if id_s in self.prefetched:
+                    yield id_s, id_e, self.prefetched.pop(id_s)
+                    continue
+                if (id_e - id_s) // self.binning == 0:
+                    continue
+                if self.one_pass:
+                    blocks.append((id_s, id_e))
+                    continue
+                yield id_s, id_e, self.read_rows(ds_proj, [(id_s, id_e)], ref_flat, ref_dark)[0]
+            if len(blocks):
+                prj_blocks = self.read_rows(ds_proj, blocks, ref_flat, ref_dark)
+                for id_s, id_e in blocks:  # hand each block over, so it is freed once the consumer is done
+                    yield id_s, id_e, prj_blocks.pop(0)
+
+    def read_rows(self, ds_proj, blocks, ref_flat, ref_dark):
+        '''
+        read row blocks [(id_s, id_e), ...] in one pass over the angles, a group of about bin_read_bytes at a time,
+        and return the normalized and binned block of each
+        '''
+        b = self.binning
+        n = [(id_e - id_s) // b for id_s, id_e in blocks]
+        r_s = self.sli[0] + blocks[0][0]
+        r_e = self.sli[0] + blocks[-1][0] + n[-1] * b
+        if b == 1 and len(blocks) == 1:
+            return [self.read_block(ds_proj, r_s, r_e, ref_flat, ref_dark)]
+        prj_blocks = [np.empty((self.n_angle, k, self.n_col // b), dtype=self.dtype) for k in n]
+        byte_per_angle = (r_e - r_s) * self.n_col * np.dtype(self.dtype).itemsize
+        n_group = max(1, int(np.ceil(bin_read_bytes / byte_per_angle)))
+        for a_s in range(0, self.n_angle, n_group):
+            a_e = min(a_s + n_group, self.n_angle)
+            prj = self.read_block(ds_proj, r_s, r_e, ref_flat, ref_dark, a_s, a_e)
+            for (id_s, id_e), k, prj_norm in zip(blocks, n, prj_blocks):
+                i = self.sli[0] + id_s - r_s
+                prj_norm[a_s:a_e] = bin_proj(prj[:, i:i + k * b], b)
+        return prj_blocks
+
+    def read_block(self, ds_proj, r_s, r_e, ref_flat, ref_dark, a_s=0, a_e=None):
+        '''
+        normalized rows r_s:r_e (detector index) of angles a_s:a_e (index in the list of angles read)
+        '''
+        a_e = self.n_angle if a_e is None else a_e
+        step = self.angle_step
+        if isinstance(ds_proj, np.memmap) or step > 1:
+            img_tomo = np.array(ds_proj[a_s * step:a_e * step:step, r_s:r_e], dtype=self.dtype)
+        else:  # chunked / compressed, split the angles across worker processes
+            img_tomo = read_scan_parallel(self.fn, self.attr_proj, [r_s, r_e], 0, self.n_worker, self.dtype,
+                                          [a_s, a_e])
+        return normalize_proj(img_tomo, ref_flat[:, r_s:r_e], ref_dark[:, r_s:r_e], out=img_tomo)
+
+    def prefetch(self, max_mem=4):
+        '''
+        Read and normalize row blocks on a background thread, until they take max_mem (GB) of memory.
+        The read-ahead stops as soon as the reader is iterated, and the prefetched blocks are handed out first.
+        '''
+        self.prefetch_stop.clear()
+        self.prefetch_thread = threading.Thread(target=self._prefetch, args=(max_mem,), daemon=True)
+        self.prefetch_thread.start()
+
+    def _prefetch(self, max_mem):
+        n_byte = 0
+        try:
+            for id_s, id_e, prj_norm in self.read_blocks():
+                if self.prefetch_stop.is_set():
+                    break
+                self.prefetched[id_s] = prj_norm
+                n_byte += prj_norm.nbytes
+                if n_byte + prj_norm.nbytes > max_mem * 1024**3:
+                    break
+        except Exception as err:
+            print(f'prefetch fails on {self.fn}: {err}')
+
+    def stop_prefetch(self):
+        if self.prefetch_thread is not None:
+            self.prefetch_stop.set()
+            self.prefetch_thread.join()
+            self.prefetch_thread = None
+
+
+class LazyProjStack:
+    '''
+    Projection stack of a scan file that reads only the frames that are looked at, e.g. by the image slider.
+    If img_flat and img_dark are given, frames are normalized as (img - img_dark) / (img_flat - img_dark),
+    see prep_util.normalize_proj().
+
+    The last cache_size frames are kept in an LRU cache, and n_ahead frames are read ahead on a
+    background thread, in the direction the stack is being browsed.
+    stack[i] gives one (read-only) frame, stack[i:j] a new array, np.array(stack) reads the whole stack.
+    '''
+    def __init__(self, fn, attr_proj='img_tomo', img_flat=None, img_dark=None, cache_size=8, n_ahead=3,
+                 dtype=None):
+        self.fn = fn
+        self.attr_proj = attr_proj
+        with open_scan(fn) as hf:
+            ds = hf[attr_proj]
+            self.shape = ds.shape
+            self.img_mm = h5_memmap(ds)
+            if not isinstance(self.img_mm, np.memmap):
+                self.img_mm = None
+            if dtype is None:
+                dtype = ds.dtype if img_flat is None else np.float32
+        self.ndim = len(self.shape)
+        self.dtype = np.dtype(dtype)
+        self.img_flat = img_flat
+        self.img_dark = 0 if img_dark is None else img_dark
+        self.cache = OrderedDict()
+        self.cache_size = cache_size
+        self.cache_lock = threading.Lock()
+        self.n_ahead = n_ahead
+        self.current_index = 0
+        self.step = 1
+        self.read_ahead_thread = None
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, index):
+        if isinstance(index, (int, np.integer)):
+            index = int(index)
+            if index < 0:
+                index += len(self)
+            if not 0 <= index < len(self):
+                raise IndexError(f'index {index} out of range for stack of {len(self)} frames')
+            if index != self.current_index:
+                self.step = 1 if index > self.current_index else -1
+            self.current_index = index
+            img = self.get_frame(index)
+            self.read_ahead()
+            return img
+        if not isinstance(index, tuple):
+            index = (index,)
+        idx = np.arange(len(self))[index[0]]
+        if np.ndim(idx) == 0:
+            return self[int(idx)][index[1:]]
+        img = np.zeros((len(idx),) + tuple(self.shape[1:]), dtype=self.dtype)
+        for i, j in enumerate(idx):
+            img[i] = self.read_frame(j)
+        return img[(slice(None),) + index[1:]]
+
+    def __array__(self, dtype=None, copy=None):
+        img = self[:]
+        return img if dtype is None else img.astype(dtype)
+
+    def astype(self, dtype):
+        return np.array(self, dtype=dtype)
+
+    def read_frame(self, i):
+        if self.img_mm is not None:
+            img = np.array(self.img_mm[i], dtype=self.dtype)
+        else:
+            with open_scan(self.fn) as hf:
+                img = np.array(hf[self.attr_proj][i], dtype=self.dtype)
+        if self.img_flat is not None:
+            img = normalize_proj(img, self.img_flat, self.img_dark, out=img)
+        return img
+
+    def get_frame(self, i):
+        with self.cache_lock:
+            if i in self.cache:
+                self.cache.move_to_end(i)
+                return self.cache[i]
+        img = self.read_frame(i)
+        img.flags.writeable = False
+        with self.cache_lock:
+            self.cache[i] = img
+            while len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+        return img
+
+    def read_ahead(self):
+        if self.n_ahead <= 0 or (self.read_ahead_thread is not None and self.read_ahead_thread.is_alive()):
+            return
+        self.read_ahead_thread = threading.Thread(target=self._read_ahead, daemon=True)
+        self.read_ahead_thread.start()
+
+    def _read_ahead(self):
+        # follow the current index, so fast browsing does not leave the thread reading stale frames
+        try:
+            while True:
+                idx = [self.current_index + k * self.step for k in range(1, self.n_ahead + 1)]
+                with self.cache_lock:
+                    idx = [i for i in idx if 0 <= i < len(self) and i not in self.cache]
+                if len(idx) == 0:
+                    break
+                self.get_frame(idx[0])
+        except Exception as err:
+            print(f'read ahead fails on {self.fn}: {err}')
+
+
+def h5_memmap(ds):
+    '''
+    Return a read-only np.memmap on h5 dataset "ds" if it is stored contiguous and uncompressed,
+    so slicing only touches the pages it needs. Otherwise (or for other backends) return "ds" itself.
+    '''
+    if not isinstance(ds, h5py.Dataset):
+        return ds
+    if ds.chunks is not None or ds.external is not None or ds.is_virtual:
+        return ds
+    if ds.file.driver not in ('sec2', 'stdio') or ds.dtype.hasobject or ds.size == 0:
+        return ds
+    offset = ds.id.get_offset()
+    if offset is None:  # space not allocated in file
+        return ds
+    return np.memmap(ds.file.filename, mode='r', dtype=ds.dtype, shape=ds.shape, offset=offset)
+
+
+def h5_array(ds, n_worker=None):
+    '''
+    memory-mapped view of h5 dataset if possible, otherwise load it into memory
+    (with read_scan_parallel for large chunked datasets).
+    Unlike the h5py dataset, the returned array stays valid after the file is closed
+    '''
+    img = h5_memmap(ds)
+    if isinstance(img, np.memmap):
+        return img
+    if (isinstance(ds, h5py.Dataset) and ds.chunks is not None and ds.nbytes > parallel_min_bytes
+            and ds.file.driver in ('sec2', 'stdio')):
+        return read_scan_parallel(ds.file.filename, ds.name, n_worker=n_worker)
+    return np.array(img)
+
+
+class TiffStack:
+    '''
+    Image stack of one TIFF file per frame. Frames are read from disk only when they are indexed
+    '''
+    def __init__(self, files):
+        self.files = files
+        img = tifffile.imread(files[0])
+        self.shape = (len(files),) + img.shape
+        self.dtype = img.dtype
+        self.ndim = len(self.shape)
+        self.chunks = (1,) + img.shape
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, index):
+        if not isinstance(index, tuple):
+            index = (index,)
+        idx = np.arange(len(self))[index[0]]
+        if np.ndim(idx) == 0:
+            return tifffile.imread(self.files[idx])[index[1:]]
+        img = None
+        for i, j in enumerate(idx):
+            tmp = tifffile.imread(self.files[j])[index[1:]]
+            if img is None:
+                img = np.zeros((len(idx),) + tmp.shape, dtype=tmp.dtype)
+            img[i] = tmp
+        if img is None:
+            img = np.zeros((0,) + self.shape[1:], dtype=self.dtype)[(slice(None),) + index[1:]]
+        return img
+
+    def __array__(self, dtype=None, copy=None):
+        img = self[:]
+        return img if dtype is None else img.astype(dtype)
+
+
+class TiffScan:
+    '''
+    Scan saved as a folder of TIFF files, read through the same interface as h5py.File:
+        hf["img_tomo"] -> sub-folder "img_tomo" with one TIFF file per projection (sorted by name),
+                          or a multi-page file "img_tomo.tiff"
+        hf["angle"]    -> "angle.txt" or "angle.npy"
+    '''
+    ext_img = ('.tiff', '.tif')
+    ext_data = ('.npy', '.txt')
+
+    def __init__(self, fn, mode='r'):
+        if not exist_tifffile:
+            raise ImportError(f'tifffile is needed to read {fn}')
+        if mode != 'r':
+            raise ValueError('TIFF scans can only be opened for reading')
+        self.filename = fn
+
+    @staticmethod
+    def is_scan(fn):
+        return os.path.isdir(fn)
+
+    @staticmethod
+    def stamp(fn):
+        return folder_stamp(fn)
+
+    def find(self, key):
+        path = os.path.join(self.filename, key)
+        if os.path.isdir(path):
+            return path
+        for ext in self.ext_img + self.ext_data:
+            if os.path.isfile(path + ext):
+                return path + ext
+        return None
+
+    def keys(self):
+        return sorted(set(os.path.splitext(f)[0] for f in os.listdir(self.filename)
+                          if self.find(os.path.splitext(f)[0]) is not None))
+
+    def __contains__(self, key):
+        return self.find(key) is not None
+
+    def __getitem__(self, key):
+        path = self.find(key)
+        if path is None:
+            raise KeyError(f'{key} not found in {self.filename}')
+        if os.path.isdir(path):
+            files = sorted(os.path.join(path, f) for f in os.listdir(path) if f.lower().endswith(self.ext_img))
+            return TiffStack(files)
+        if path.endswith('.npy'):
+            return np.load(path)
+        if path.endswith('.txt'):
+            return np.loadtxt(path)
+        return tifffile.imread(path)
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class ZarrScan:
+    '''
+    Scan saved as a local zarr group (directory store) with the same dataset names as the h5 files.
+    Every chunk is a file of its own, so worker processes read chunks in parallel without any lock.
+    '''
+    def __init__(self, fn, mode='r'):
+        if not exist_zarr:
+            raise ImportError(f'zarr is needed to read {fn}')
+        self.filename = fn
+        self.group = zarr.open_group(fn, mode=mode)
+
+    @staticmethod
+    def is_scan(fn):
+        if not os.path.isdir(fn):
+            return False
+        return (fn.rstrip('/').endswith('.zarr') or os.path.exists(os.path.join(fn, '.zgroup'))
+                or os.path.exists(os.path.join(fn, 'zarr.json')))
+
+    @staticmethod
+    def stamp(fn):
+        return folder_stamp(fn)
+
+    def keys(self):
+        return list(self.group.keys())
+
+    def __contains__(self, key):
+        return key in self.group
+
+    def __getitem__(self, key):
+        return self.group[key]
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+# checked in order by open_scan(); anything else is opened as an h5 file
+scan_readers = [ZarrScan, TiffScan]
+
+
+def open_scan(fn, mode='r'):
+    '''
+    Open scan "fn" with the reader of its format (zarr group, folder of TIFF files or h5 file).
+    The returned object works like an h5py.File: hf[attr] gives an array-like dataset,
+    "attr in hf" and "with open_scan(fn) as hf:" are supported
+    '''
+    for reader in scan_readers:
+        if reader.is_scan(fn):
+            return reader(fn, mode)
+    return h5py.File(fn, mode)
+
+
+def folder_stamp(fn):
+    '''
+    (mtime, size) of a scan folder: latest mtime and total size of the files in it, since overwriting a file
+    (e.g. a TIFF frame or a zarr chunk) in place does not change the mtime of the folder
+    '''
+    mtime, size = os.path.getmtime(fn), 0
+    for path, dirs, files in os.walk(fn):
+        for f in files:
+            st = os.stat(os.path.join(path, f))
+            mtime = max(mtime, st.st_mtime)
+            size += st.st_size
+    return mtime, size
+
+
+def list_scans(path, prefix='', attr_proj='img_tomo', file_type='.h5'):
+    '''
+    sorted full paths of the scans in folder "path" whose name starts with prefix: files ending with file_type,
+    and folders (zarr stores, TIFF folders) that open_scan() can read and that hold dataset attr_proj
+    '''
+    path = os.path.abspath(path)
+    scans = []
+    for f in sorted(os.listdir(path)):
+        fn = os.path.join(path, f)
+        if not f.startswith(prefix):
+            continue
+        if os.path.isdir(fn):
+            try:
+                with open_scan(fn) as hf:
+                    if attr_proj in hf:
+                        scans.append(fn)
+            except Exception:
+                pass
+        elif f.endswith(file_type):
+            scans.append(fn)
+    return scans
+
+
+def scan_stamp(fn):
+    '''
+    (mtime, size) of scan fn, which changes whenever its data does, used to check cached results
+    '''
+    for reader in scan_readers:
+        if reader.is_scan(fn):
+            return reader.stamp(fn)
+    st = os.stat(fn)
+    return st.st_mtime, st.st_size
+
+
+proc_pool = None
+proc_pool_lock = threading.Lock()
+parallel_min_bytes = 64 * 1024**2 # smaller reads are not worth the overhead of worker processes
+bin_read_bytes = 64 * 1024**2  # full resolution data read at a time by a binning ProjBlockReader
+stream_mem_frac = 0.5  # fraction of the available memory the blocks of one chunked read pass may use
+
+
+def get_proc_pool(n_worker=None):
+    '''
+    persistent pool of worker processes, created once per process with at least cpu_count() // 2 workers.
+    It is never re-created, as other threads (e.g. prefetch of ProjBlockReader) may be using it;
+    callers bound their parallelism by the number of tasks they hand to it
+    '''
+    global proc_pool
+    with proc_pool_lock:
+        if proc_pool is None:
+            n_worker = max(n_worker or 1, cpu_count() // 2, 1)
+            # fork while holding the h5py lock, so no thread is inside h5py at the moment of the fork
+            with h5py._objects.phil:
+                proc_pool = Pool(processes=n_worker)
+    return proc_pool
+
+
+def shared_array(shape, dtype):
+    '''
+    array backed by a file in /dev/shm, which worker processes can open with np.memmap(fn_shm, mode='r+').
+    The file is removed with os.remove() once the workers are done; the memory is freed with the array
+    '''
+    fd, fn_shm = tempfile.mkstemp(prefix='pytomo_', dir='/dev/shm' if os.path.isdir('/dev/shm') else None)
+    os.close(fd)
+    return np.memmap(fn_shm, mode='w+', dtype=dtype, shape=shape), fn_shm
+
+
+def split_range(n, n_part, align=1):
+    '''
+    split range(n) into at most n_part [start, end) pieces, with boundaries at multiples of align
+    '''
+    n_block = int(np.ceil(n / align))
+    bound = np.unique(np.linspace(0, n_block, min(n_part, n_block) + 1).astype(int) * align)
+    bound[-1] = n
+    return [(int(bound[i]), int(bound[i+1])) for i in range(len(bound) - 1)]
+
+
+recon_mem_frac = 0.25  # fraction of the available memory a reconstruction chunk may use
+
+
+def available_memory():
+    '''
+    bytes of memory available for new allocations (MemAvailable of /proc/meminfo, free pages elsewhere)
+    '''
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    try:
+        return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+    except (ValueError, OSError, AttributeError):
+        return 8 * 1024**3
+
+
+def recon_chunk_size(n_angle, n_row, n_col, binning=1, dtype=np.float32, mem_frac=None, n_core=None):
+    '''
+    number of (binned) slices reconstructed together, for projections of n_angle x n_row x n_col (unbinned) pixels.
+    A chunk is held about 6 times as projections (read-ahead, stripe removal and denoise buffers) and 6 times as
+    reconstructed slices (gridrec output, mask, writer queue); together they may take mem_frac of the available memory.
+    The result is rounded down to a multiple of the core count, so gridrec keeps all cores busy, and limited
+    to a quarter of the slices, so reading and preprocessing still overlap with the reconstruction
+    '''
+    n_row = max(1, n_row // binning)
+    n_col = max(1, n_col // binning)
+    n_core = n_core or cpu_count()
+    mem_frac = recon_mem_frac if mem_frac is None else mem_frac
+    byte_per_slice = np.dtype(dtype).itemsize * 6 * (n_angle * n_col + n_col * n_col)
+    n_sli = int(available_memory() * mem_frac // byte_per_slice)
+    if n_sli >= n_core:
+        n_sli = n_sli // n_core * n_core
+    n_sli = min(n_sli, max(n_core, int(np.ceil(n_row / 4))))
+    return int(max(1, min(n_sli, n_row)))
+
+
+def _read_scan_worker(args):
+    fn, attr, sel, fn_shm, shape, dtype, part = args
+    img = np.memmap(fn_shm, mode='r+', dtype=dtype, shape=shape)
+    with open_scan(fn) as hf:
+        img[part] = hf[attr][sel]
+    img.flush()
+
+
+def read_scan_parallel(fn, attr, sli=[], axis=0, n_worker=None, dtype=None, sli_angle=[]):
+    '''
+    Read dataset "attr" of scan fn (only rows sli[0]:sli[1] along axis 1, and frames sli_angle[0]:sli_angle[1]
+    along axis 0, if given) into memory.
+    The range along "axis" is split, at chunk boundaries, across worker processes that each open the
+    scan and decompress their part into shared memory. h5py serializes all reads inside one process,
+    so this is what lets loading a compressed scan scale with cores.
+    '''
+    with open_scan(fn) as hf:
+        ds = hf[attr]
+        s = ds.shape
+        chunks = ds.chunks
+        if dtype is None:
+            dtype = ds.dtype
+    sel = [slice(0, n) for n in s]
+    if len(sli) == 2:
+        sel[1] = slice(int(sli[0]), int(sli[1]))
+    if len(sli_angle) == 2:
+        sel[0] = slice(int(sli_angle[0]), int(sli_angle[1]))
+    # clamp to the dataset, like slicing the array would
+    sel = [slice(*sl.indices(n)[:2]) for sl, n in zip(sel, s)]
+    sel = [slice(sl.start, max(sl.start, sl.stop)) for sl in sel]
+    shape = tuple(sl.stop - sl.start for sl in sel)
+    align = chunks[axis] if chunks is not None else 1
+    parts = split_range(shape[axis], n_worker or max(1, cpu_count() // 2), align)
+    n_byte = int(np.prod(shape)) * np.dtype(dtype).itemsize
+    if len(parts) < 2 or n_byte < parallel_min_bytes:
+        with open_scan(fn) as hf:
+            return np.array(hf[attr][tuple(sel)], dtype=dtype)
+    img, fn_shm = shared_array(shape, dtype)
+    try:
+        args = []
+        for p_s, p_e in parts:
+            sel_p = list(sel)
+            sel_p[axis] = slice(sel[axis].start + p_s, sel[axis].start + p_e)
+            part = [slice(None)] * len(shape)
+            part[axis] = slice(p_s, p_e)
+            args.append((fn, attr, tuple(sel_p), fn_shm, shape, dtype, tuple(part)))
+        get_proc_pool(n_worker).map(_read_scan_worker, args)
+    finally:
+        os.remove(fn_shm)
+    return img.view(np.ndarray)
+
+
+ref_cache = OrderedDict()
+ref_cache_size = 8
+ref_cache_lock = threading.Lock()
+
+
+def load_flat_dark(fn, attr_flat='img_bkg', attr_dark='img_dark', dark_scale=1, ref_method='median', rows=None):
+    '''
+    Median flat and dark field of scan file "fn", each with shape (1, n_row, n_col).
+    The dark field is already divided by dark_scale.
+    attr_flat or attr_dark may be None to load only the other one, None is returned in its place.
+    ref_method='trim_mean' averages the frames instead, without the brightest and darkest 10% at each pixel.
+    rows=(r_s, r_e) gives only those rows, shape (1, r_e - r_s, n_col); they are cut from the whole frames if
+    those are cached already, otherwise only these rows are read from the file.
+
+    Results are kept in an in-memory LRU cache keyed by file path, scan_stamp(), dataset names, dark_scale and rows.
+    Returned arrays are read-only, since they are shared between callers.
+    '''
+    fn = os.path.abspath(fn)
+    key = (fn, scan_stamp(fn), attr_flat, attr_dark, float(dark_scale), ref_method)
+    if rows is not None:
+        rows = tuple(int(r) for r in rows)
+    with ref_cache_lock:
+        if key in ref_cache:
+            ref_cache.move_to_end(key)
+            ref = ref_cache[key]
+            if rows is None:
+                return ref
+            return tuple(None if img is None else img[:, rows[0]:rows[1]] for img in ref)
+        if rows is not None:
+            key = key + (rows,)
+            if key in ref_cache:
+                ref_cache.move_to_end(key)
+                return ref_cache[key]
+
+    with open_scan(fn) as hf:
+        img_flat = None if attr_flat is None else median_ref(hf[attr_flat], ref_method, rows)
+        img_dark = None if attr_dark is None else median_ref(hf[attr_dark], ref_method, rows) / np.float32(dark_scale)
+    ref = (img_flat, img_dark)
+    for img in ref:
+        if img is not None:
+            img.flags.writeable = False
+
+    with ref_cache_lock:
+        ref_cache[key] = ref
+        ref_cache.move_to_end(key)
+        while len(ref_cache) > ref_cache_size:
+            ref_cache.popitem(last=False)
+    return ref
+
+
+def median_ref(ds, method='median', rows=None):
+    '''
+    median (or trimmed mean, method='trim_mean') of flat / dark frames with shape (1, n_row, n_col),
+    reduced tile by tile from the dataset within prep_util.ref_mem_limit.
+    rows=(r_s, r_e) reduces only those rows
+    '''
+    ds = h5_memmap(ds)
+    if rows is not None:
+        ds = ds[:, rows[0]:rows[1]] if len(ds.shape) == 3 else ds[rows[0]:rows[1]]
+    return reduce_frames(ds, method=method)
+
+
+def clear_ref_cache():
+    with ref_cache_lock:
+        ref_cache.clear()
+
+
+def quantize_img(img, quantize=None, vmin=None, vmax=None):
+    '''
+    quantize: None (keep dtype), 'float32' or 'uint16'.
+    For 'uint16', values in [vmin, vmax] (default: min and max of img) are scaled to [0, 65535].
+    Return (img_q, scale, offset), with img = img_q * scale + offset
+    '''
+    if quantize is None:
+        return img, 1, 0
+    if quantize == 'float32':
+        return img.astype(np.float32, copy=False), 1, 0
+    if quantize != 'uint16':
+        raise ValueError(f'quantize type {quantize} not supported')
+    vmin = float(np.min(img)) if vmin is None else float(vmin)
+    vmax = float(np.max(img)) if vmax is None else float(vmax)
+    scale = (vmax - vmin) / 65535 if vmax > vmin else 1.0
+    img_q = np.clip(np.round((img - vmin) / scale), 0, 65535).astype(np.uint16)
+    return img_q, scale, vmin
+
+
+def write_recon_img(hf, rec, compression=None, quantize=None, name='img'):
+    '''
+    Write reconstruction "rec" to h5 file/group hf, chunked by slice so that reading single slices is cheap.
+    compression: None, 'gzip' or 'lzf'
+    quantize: see quantize_img(). Scale and offset are stored as attributes of the dataset
+    '''
+    img, scale, offset = quantize_img(rec, quantize)
+    chunks = (1,) + img.shape[1:] if img.ndim == 3 else None
+    ds = hf.create_dataset(name, data=img, chunks=chunks, compression=compression)
+    if quantize == 'uint16':
+        ds.attrs['scale'] = scale
+        ds.attrs['offset'] = offset
+    return ds
+
+
+def read_recon_img(ds, sli=slice(None), hf=None):
+    '''
+    read reconstruction dataset, and undo the uint16 quantization of write_recon_img() if applied.
+    hf: group holding ds, needed for zarr stores (h5 datasets know their parent)
+    '''
+    img = ds[sli]
+    if hf is None:
+        hf = ds.parent
+    if 'scale' in ds.attrs:
+        img = img.astype(np.float32) * np.float32(ds.attrs['scale']) + np.float32(ds.attrs['offset'])
+    elif 'img_scale' in hf:  # per-slice scale of ReconH5Writer
+        scale = np.float32(hf['img_scale'][sli])
+        offset = np.float32(hf['img_offset'][sli])
+        scale = np.reshape(scale, np.shape(scale) + (1,) * (img.ndim - np.ndim(scale)))
+        offset = np.reshape(offset, np.shape(offset) + (1,) * (img.ndim - np.ndim(offset)))
+        img = img.astype(np.float32) * scale + offset
+    return img
+
+
+def load_recon(fn, sli=slice(None)):
+    '''
+    read the reconstructed volume "img" of an h5 file or zarr store written by recon_and_save
+    '''
+    with open_scan(fn) as hf:
+        return read_recon_img(hf['img'], sli, hf)
+
+
+class ReconH5Writer:
+    '''
+    Write reconstructed slices into a preallocated "img" dataset of fsave as soon as they are produced,
+    so the full volume never has to be kept in memory.
+
+    shape: (n_slice, n_row, n_col) of the full reconstructed slices
+    roi: [r_s, r_e, c_s, c_e], crop applied to each slice before writing
+    compression, quantize: same as write_recon_img(). With quantize='uint16', every slice gets its
+        own scale and offset, stored in datasets "img_scale" and "img_offset"
+    meta: dict of small datasets saved along with the image, e.g. rot_cen, binning
+    param: string describing the reconstruction parameters, saved as "recon_param"
+    resume: if fsave exists and was written with the same param and shape, keep the slices finished
+        there (recorded in dataset "slice_done") and only write the missing ones
+
+    The file is only opened while a chunk is written, so finished slices can be read while the
+    reconstruction is running, and an interrupted job leaves a valid file behind.
+    '''
+    def __init__(self, fsave, shape, dtype=np.float32, roi=None, compression=None, quantize=None, meta={},
+                 param='', resume=False):
+        self.fsave = fsave
+        self.quantize = quantize
+        if roi is None:
+            roi = [0, shape[1], 0, shape[2]]
+        self.roi = roi
+        if quantize == 'uint16':
+            dtype = np.uint16
+        elif quantize == 'float32':
+            dtype = np.float32
+        elif quantize is not None:
+            raise ValueError(f'quantize type {quantize} not supported')
+        s = (shape[0], roi[1] - roi[0], roi[3] - roi[2])
+        if resume and self.load_checkpoint(s, dtype, param):
+            return
+        self.create(s, dtype, compression, meta, param)
+        self.done = np.zeros(s[0], dtype=bool)
+
+    def create(self, s, dtype, compression, meta, param):
+        with h5py.File(self.fsave, 'w') as hf:
+            hf.create_dataset('img', s, dtype=dtype, chunks=(1, s[1], s[2]), compression=compression)
+            if self.quantize == 'uint16':
+                hf.create_dataset('img_scale', data=np.ones(s[0]))
+                hf.create_dataset('img_offset', data=np.zeros(s[0]))
+            for key, val in meta.items():
+                hf.create_dataset(key, data=val)
+            hf.create_dataset('recon_param', data=param)
+            hf.create_dataset('slice_done', data=np.zeros(s[0], dtype=np.uint8))
+
+    def load_checkpoint(self, s, dtype, param):
+        if not os.path.exists(self.fsave):
+            return False
+        try:
+            with h5py.File(self.fsave, 'r') as hf:
+                match = ('slice_done' in hf and 'recon_param' in hf
+                         and hf['recon_param'][()].decode() == param
+                         and hf['img'].shape == s and hf['img'].dtype == np.dtype(dtype)
+                         and (self.quantize != 'uint16' or 'img_scale' in hf))
+                if match:
+                    self.done = np.array(hf['slice_done'][()], dtype=bool)
+        except Exception as err:
+            print(f'can not resume from {self.fsave}: {err}')
+            return False
+        if match:
+            print(f'resume {self.fsave}: {np.sum(self.done)} of {s[0]} slices already reconstructed')
+        return match
+
+    def open(self, n_try=30):
+        # the file may be locked for a moment by a reader, e.g. when viewing the partial result
+        for i in range(n_try):
+            try:
+                return h5py.File(self.fsave, 'r+')
+            except BlockingIOError:
+                if i == n_try - 1:
+                    raise
+                time.sleep(1)
+
+    def is_done(self, id_s=0, id_e=None):
+        return bool(np.all(self.done[id_s:id_e]))
+
+    def quantize_slab(self, rec_sub):
+        '''
+        crop rec_sub to roi (unless it is cropped already), and quantize it slice by slice if quantize='uint16'.
+        Return (img, scale, offset)
+        '''
+        r_s, r_e, c_s, c_e = self.roi
+        img = rec_sub
+        if img.shape[1:] != (r_e - r_s, c_e - c_s):
+            img = rec_sub[:, r_s:r_e, c_s:c_e]
+        if self.quantize != 'uint16':
+            return img, None, None
+        vmin = np.min(img, axis=(1, 2))
+        vmax = np.max(img, axis=(1, 2))
+        scale = np.where(vmax > vmin, (vmax - vmin) / 65535, 1.0)
+        img = (img - vmin[:, None, None]) / scale[:, None, None]
+        img = np.clip(np.round(img), 0, 65535)
+        return img, scale, vmin
+
+    def write(self, id_s, id_e, rec_sub):
+        img, scale, offset = self.quantize_slab(rec_sub)
+        with self.open() as hf:
+            if scale is not None:
+                hf['img_scale'][id_s:id_e] = scale
+                hf['img_offset'][id_s:id_e] = offset
+            hf['img'][id_s:id_e] = img.astype(hf['img'].dtype, copy=False)
+            hf.flush()
+            # mark slices as finished only after the image data is on disk
+            hf['slice_done'][id_s:id_e] = 1
+        self.done[id_s:id_e] = True
+
+    def close(self):
+        n = int(np.sum(self.done))
+        if n == len(self.done):
+            print(f'all {n} slices saved to {self.fsave}')
+        else:
+            print(f'{n} of {len(self.done)} slices saved to {self.fsave}, run again with resume to finish')
+
+
+def zarr_array(group, name, data=None, shape=None, dtype=None, chunks=None, compress=True):
+    '''
+    create array "name" in zarr group (zarr 2 or 3), with the default compressor or none
+    '''
+    if data is not None:
+        data = np.asarray(data)
+        shape, dtype = data.shape, data.dtype
+    kw = {} if chunks is None else {'chunks': chunks}
+    if hasattr(group, 'create_array'):  # zarr 3
+        if not compress:
+            kw['compressors'] = None
+        arr = group.create_array(name, shape=shape, dtype=dtype, **kw)
+    else:
+        if not compress:
+            kw['compressor'] = None
+        arr = group.create_dataset(name, shape=shape, dtype=dtype, **kw)
+    if data is not None:
+        arr[...] = data
+    return arr
+
+
+class ReconZarrWriter(ReconH5Writer):
+    '''
+    Same as ReconH5Writer, but the volume goes to a local zarr store (directory) with one chunk file per
+    slice and tile. Slabs handed to write() are compressed and written by n_worker threads while the next
+    slab is reconstructed; at most n_worker slabs wait in the queue.
+    Each volume is a store of its own, so several reconstructions can write at the same time, and any
+    sub-volume can be read without touching the rest.
+    compression: None for uncompressed chunks, anything else for the default zarr compressor
+    '''
+    def __init__(self, fsave, shape, dtype=np.float32, roi=None, compression=None, quantize=None, meta={},
+                 param='', resume=False, n_worker=4, tile=512):
+        if not exist_zarr:
+            raise ImportError('zarr is needed to save the reconstruction as zarr store')
+        self.n_worker = n_worker
+        self.tile = tile
+        self.pending = []
+        super().__init__(fsave, shape, dtype, roi, compression, quantize, meta, param, resume)
+        # only once the store is set up, so a failing __init__ leaves no threads behind
+        self.executor = ThreadPoolExecutor(max_workers=n_worker)
+
+    def create(self, s, dtype, compression, meta, param):
+        self.group = zarr.open_group(self.fsave, mode='w')
+        compress = compression is not None
+        # one slice per chunk, so slabs written at the same time never share a chunk
+        zarr_array(self.group, 'img', shape=s, dtype=dtype, compress=compress,
+                   chunks=(1, min(self.tile, s[1]), min(self.tile, s[2])))
+        if self.quantize == 'uint16':
+            zarr_array(self.group, 'img_scale', np.ones(s[0]), chunks=(1,))
+            zarr_array(self.group, 'img_offset', np.zeros(s[0]), chunks=(1,))
+        for key, val in meta.items():
+            zarr_array(self.group, key, val)
+        zarr_array(self.group, 'slice_done', np.zeros(s[0], dtype=np.uint8), chunks=(1,))
+        self.group.attrs['recon_param'] = param
+
+    def load_checkpoint(self, s, dtype, param):
+        if not os.path.isdir(self.fsave):
+            return False
+        try:
+            group = zarr.open_group(self.fsave, mode='r+')
+            match = ('slice_done' in group and group.attrs.get('recon_param') == param
+                     and group['img'].shape == s and group['img'].dtype == np.dtype(dtype)
+                     and (self.quantize != 'uint16' or 'img_scale' in group))
+        except Exception as err:
+            print(f'can not resume from {self.fsave}: {err}')
+            return False
+        if match:
+            self.group = group
+            self.done = np.array(group['slice_done'][:], dtype=bool)
+            print(f'resume {self.fsave}: {np.sum(self.done)} of {s[0]} slices already reconstructed')
+        return match
+
+    def wait(self, n_pending=0):
+        while len(self.pending) > n_pending:
+            self.pending.pop(0).result()
+
+    def write(self, id_s, id_e, rec_sub):
+        self.wait(self.n_worker - 1)
+        self.pending.append(self.executor.submit(self.write_slab, id_s, id_e, rec_sub))
+
+    def write_slab(self, id_s, id_e, rec_sub):
+        img, scale, offset = self.quantize_slab(rec_sub)
+        if scale is not None:
+            self.group['img_scale'][id_s:id_e] = scale
+            self.group['img_offset'][id_s:id_e] = offset
+        ds = self.group['img']
+        ds[id_s:id_e] = img.astype(ds.dtype, copy=False)
+        self.group['slice_done'][id_s:id_e] = 1
+        self.done[id_s:id_e] = True
+
+    def close(self):
+        try:
+            self.wait()
+        finally:
+            self.executor.shutdown()
+        super().close()
+
+
+scan_index_path = os.path.join(os.path.expanduser('~'), '.fxi_tomo_util', 'scan_index.sqlite')
+
+
+def read_scan_header(fn, attr_proj='img_tomo', attr_angle='angle', attr_xeng='X_eng', attr_sid='scan_id'):
+    '''
+    shape, energy, scan id and angle range of scan fn, without reading any image data
+    '''
+    info = {}
+    with open_scan(fn) as hf:
+        if attr_proj in hf:
+            s = hf[attr_proj].shape
+            info['n_angle'], info['n_row'], info['n_col'] = [int(n) for n in (1,) * (3 - len(s)) + tuple(s[-3:])]
+        if attr_xeng in hf:
+            info['x_eng'] = float(np.array(hf[attr_xeng]).ravel()[0])
+        if attr_sid in hf:
+            info['scan_id'] = int(np.array(hf[attr_sid]).ravel()[0])
+        if attr_angle in hf:
+            ang = hf[attr_angle]
+            if ang.ndim and ang.shape[0]:
+                info['angle_start'] = float(ang[0])
+                info['angle_end'] = float(ang[-1])
+    return info
+
+
+def _read_header_worker(args):
+    fn, attrs = args
+    try:
+        return fn, read_scan_header(fn, *attrs), ''
+    except Exception as err:
+        return fn, {}, str(err)
+
+
+class ScanIndex:
+    '''
+    Persistent SQLite index of scan headers (shape, X_eng, scan id and angle range), so thousands of scans
+    can be listed and filtered without opening every file again.
+    An entry is read again when the mtime or size of the scan changes (see scan_stamp()), or when other dataset
+    names are used.
+    update() reads the headers of new or changed files with worker processes, by default on a background thread.
+    '''
+    columns = {'n_angle': 'INTEGER', 'n_row': 'INTEGER', 'n_col': 'INTEGER', 'x_eng': 'REAL',
+               'scan_id': 'INTEGER', 'angle_start': 'REAL', 'angle_end': 'REAL'}
+
+    def __init__(self, fn_db=None, attr_proj='img_tomo', attr_angle='angle', attr_xeng='X_eng', attr_sid='scan_id',
+                 n_worker=None):
+        self.fn_db = scan_index_path if fn_db is None else fn_db
+        self.attrs = (attr_proj, attr_angle, attr_xeng, attr_sid)
+        self.n_worker = n_worker
+        self.pending = []
+        self.lock = threading.Lock()
+        self.thread = None
+        os.makedirs(os.path.dirname(os.path.abspath(self.fn_db)), exist_ok=True)
+        col = ', '.join(f'{c} {t}' for c, t in self.columns.items())
+        self.execute(f'CREATE TABLE IF NOT EXISTS scan (path TEXT PRIMARY KEY, mtime REAL, size INTEGER, '
+                     f'attrs TEXT, {col}, error TEXT)')
+
+    def execute(self, sql, rows=None):
+        db = sqlite3.connect(self.fn_db, timeout=30)
+        try:
+            if rows is None:
+                res = db.execute(sql).fetchall()
+            else:
+                res = db.executemany(sql, rows).fetchall()
+            db.commit()
+        finally:
+            db.close()
+        return res
+
+    def fetch(self, files):
+        '''
+        {path: entry} of the files in the index, whether up to date or not
+        '''
+        entry = {}
+        files = [os.path.abspath(fn) for fn in files]
+        keys = ['path', 'mtime', 'size', 'attrs'] + list(self.columns) + ['error']
+        db = sqlite3.connect(self.fn_db, timeout=30)
+        try:
+            for i in range(0, len(files), 500):
+                part = files[i:i+500]
+                sql = f'SELECT {", ".join(keys)} FROM scan WHERE path IN ({", ".join("?" * len(part))})'
+                for row in db.execute(sql, part):
+                    entry[row[0]] = dict(zip(keys, row))
+        finally:
+            db.close()
+        return entry
+
+    def is_current(self, entry, fn):
+        try:
+            mtime, size = scan_stamp(fn)
+        except OSError:
+            return False
+        return entry['mtime'] == mtime and entry['size'] == size and entry['attrs'] == '|'.join(self.attrs)
+
+    def lookup(self, files):
+        '''
+        {path: header} of the files with an up-to-date entry in the index
+        '''
+        entry = self.fetch(files)
+        return {fn: e for fn, e in entry.items() if self.is_current(e, fn)}
+
+    def query(self, folder=None, **ranges):
+        '''
+        entries of the scans in folder (all folders if None), sorted by path, e.g.
+            query('/data/beamtime', x_eng=(8.3, 8.4), n_angle=(900, None))
+        '''
+        keys = ['path', 'mtime', 'size', 'attrs'] + list(self.columns) + ['error']
+        cond, args = [], []
+        if folder is not None:
+            cond.append('path LIKE ?')
+            args.append(os.path.join(os.path.abspath(folder), '%'))
+        for col, (vmin, vmax) in ranges.items():
+            if col not in self.columns:
+                raise ValueError(f'unknown column {col}, use one of {list(self.columns)}')
+            if vmin is not None:
+                cond.append(f'{col} >= ?')
+                args.append(vmin)
+            if vmax is not None:
+                cond.append(f'{col} <= ?')
+                args.append(vmax)
+        sql = f'SELECT {", ".join(keys)} FROM scan'
+        if len(cond):
+            sql += ' WHERE ' + ' AND '.join(cond)
+        db = sqlite3.connect(self.fn_db, timeout=30)
+        try:
+            rows = db.execute(sql + ' ORDER BY path', args).fetchall()
+        finally:
+            db.close()
+        return [dict(zip(keys, row)) for row in rows]
+
+    def is_running(self):
+        return self.thread is not None and self.thread.is_alive()
+
+    def update(self, files, background=True):
+        with self.lock:
+            self.pending.extend(os.path.abspath(fn) for fn in files)
+            if self.is_running():  # the running thread picks up the new files
+                return
+            if background:
+                self.thread = threading.Thread(target=self._update, daemon=True)
+                self.thread.start()
+                return
+        self._update()
+
+    def _update(self):
+        while True:
+            with self.lock:
+                files, self.pending = self.pending, []
+            if len(files) == 0:
+                break
+            try:
+                self.index_files(files)
+            except Exception as err:
+                print(f'fails to index scan files: {err}')
+
+    def index_files(self, files):
+        entry = self.fetch(files)
+        attrs = '|'.join(self.attrs)
+        stat = {}
+        for fn in files:
+            if fn in entry and self.is_current(entry[fn], fn):
+                continue
+            try:
+                stat[fn] = scan_stamp(fn)
+            except OSError:
+                pass
+        if len(stat) == 0:
+            return
+        args = [(fn, self.attrs) for fn in stat]
+        if len(args) > 1 and self.n_worker != 1:
+            res = get_proc_pool(self.n_worker).imap_unordered(_read_header_worker, args, chunksize=8)
+        else:
+            res = map(_read_header_worker, args)
+        sql = f'INSERT OR REPLACE INTO scan VALUES ({", ".join("?" * (len(self.columns) + 5))})'
+        rows = []
+        for fn, info, err in res:
+            rows.append((fn, stat[fn][0], stat[fn][1], attrs) + tuple(info.get(c) for c in self.columns)
+                        + (err,))
+            if len(rows) == 100:
+                self.execute(sql, rows)
+                rows = []
+        if len(rows):
+            self.execute(sql, rows)
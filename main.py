@@ -1,5 +1,4 @@
 import sys
-import h5py
 import matplotlib.pyplot as plt
 import numpy as np
 import json
@@ -130,6 +129,10 @@ class App(QWidget):
         self.current_file_short = ''
         self.enable_multi_selection()
         self.slider = []
+        self.prefetch_mem = 4 # GB, memory budget for loading the next file during batch reconstruction
+        self.scan_index = None
+        self.scan_index_timer = QtCore.QTimer()
+        self.scan_index_timer.timeout.connect(self.check_scan_index)
         self.ml_model_path = f'{self.fpath}/saved_model/transmission_bkg_removal/bkg_removal_RRDB4.pth.pth'
         self.ml_model_recon_path = f'{self.fpath}/saved_model/tomo_denoise/tomo_denoise_RRDB4.pth'
         self.ml_model_path_default = self.ml_model_path
@@ -500,8 +503,13 @@ class App(QWidget):
         self.cb_rc_algorithm.setFont(self.font2)
         self.cb_rc_algorithm.setFixedWidth(80)
         self.cb_rc_algorithm.addItem('gridrec')
+        self.cb_rc_algorithm.addItem('fbp')
+        self.cb_rc_algorithm.addItem('sirt')
+        self.cb_rc_algorithm.addItem('cgls')
         self.cb_rc_algorithm.addItem('astra_fbp')
         self.cb_rc_algorithm.addItem('astra_sirt')
+        self.cb_rc_algorithm.setToolTip("'sirt' and 'cgls' run on the cpu and need heavy binning "
+                                        "(e.g. 4 or more for 1280 x 1280 slices)")
     
         lb_rc_algorithm_iter = QLabel()
         lb_rc_algorithm_iter.setText('Iter:')
@@ -690,6 +698,8 @@ class App(QWidget):
         lb_empty1.setFixedHeight(10)
         lb_empty2 = QLabel()
         lb_empty2.setFixedWidth(10)
+        lb_empty3 = QLabel()
+        lb_empty3.setFixedWidth(10)
 
         lb_link = QLabel()
         lb_link.setText('Function applied to the "proj. files" list:')
@@ -797,6 +807,48 @@ class App(QWidget):
         self.tx_auto_bl_ratio.setText('0.4')
         self.tx_auto_bl_ratio.setFont(self.font2)
 
+        lb_rec_save_type = QLabel()
+        lb_rec_save_type.setText('save as:')
+        lb_rec_save_type.setFixedWidth(85)
+        lb_rec_save_type.setFont(self.font2)
+
+        self.cb_rec_save_type = QComboBox()
+        self.cb_rec_save_type.setFont(self.font2)
+        self.cb_rec_save_type.setFixedWidth(80)
+        self.cb_rec_save_type.addItem('float32')
+        self.cb_rec_save_type.addItem('uint16')
+
+        lb_rec_compress = QLabel()
+        lb_rec_compress.setText('compress:')
+        lb_rec_compress.setFixedWidth(85)
+        lb_rec_compress.setFont(self.font2)
+        lb_rec_compress.setAlignment(QtCore.Qt.AlignRight | QtCore.Qt.AlignVCenter)
+
+        self.cb_rec_compress = QComboBox()
+        self.cb_rec_compress.setFont(self.font2)
+        self.cb_rec_compress.setFixedWidth(80)
+        self.cb_rec_compress.addItem('None')
+        self.cb_rec_compress.addItem('lzf')
+        self.cb_rec_compress.addItem('gzip')
+
+        lb_rec_format = QLabel()
+        lb_rec_format.setText('format:')
+        lb_rec_format.setFixedWidth(85)
+        lb_rec_format.setFont(self.font2)
+        lb_rec_format.setAlignment(QtCore.Qt.AlignRight | QtCore.Qt.AlignVCenter)
+
+        self.cb_rec_format = QComboBox()
+        self.cb_rec_format.setFont(self.font2)
+        self.cb_rec_format.setFixedWidth(80)
+        self.cb_rec_format.addItem('h5')
+        self.cb_rec_format.addItem('zarr')
+
+        self.chkbox_rec_incremental = QCheckBox('write by chunk')
+        self.chkbox_rec_incremental.setFont(self.font2)
+        self.chkbox_rec_incremental.setFixedWidth(120)
+        self.chkbox_rec_incremental.setChecked(False)
+        self.chkbox_rec_incremental.setToolTip('save each reconstructed chunk directly to file to reduce memory usage')
+
         self.pb_rec_s = QPushButton('Recon single')
         self.pb_rec_s.setFixedWidth(170)
         self.pb_rec_s.setFixedHeight(40)
@@ -869,6 +921,18 @@ class App(QWidget):
         hbox_rec2.addStretch()
         hbox_rec2.setAlignment(QtCore.Qt.AlignTop | QtCore.Qt.AlignLeft)
 
+        hbox_rec_save = QHBoxLayout()
+        hbox_rec_save.addWidget(lb_rec_save_type)
+        hbox_rec_save.addWidget(self.cb_rec_save_type)
+        hbox_rec_save.addWidget(lb_rec_compress)
+        hbox_rec_save.addWidget(self.cb_rec_compress)
+        hbox_rec_save.addWidget(lb_rec_format)
+        hbox_rec_save.addWidget(self.cb_rec_format)
+        hbox_rec_save.addWidget(lb_empty3)
+        hbox_rec_save.addWidget(self.chkbox_rec_incremental)
+        hbox_rec_save.addStretch()
+        hbox_rec_save.setAlignment(QtCore.Qt.AlignTop | QtCore.Qt.AlignLeft)
+
         hbox_rec3 = QHBoxLayout()
         hbox_rec3.addWidget(self.pb_rec_s)
         hbox_rec3.addWidget(self.pb_rec_b)
@@ -889,6 +953,7 @@ class App(QWidget):
         vbox_rec.addWidget(lb_empty1)
         vbox_rec.addLayout(hbox_rec1)
         vbox_rec.addLayout(hbox_rec2)
+        vbox_rec.addLayout(hbox_rec_save)
         if torch_installed:
             vbox_rec.addLayout(vbox_ml)
         vbox_rec.addLayout(vbox_rec_view)
@@ -1416,7 +1481,7 @@ class App(QWidget):
             fn = self.fname_rc[fn_short]['full_path']
 
             self.load_proj_file(fn)  # get self.img_prj_norm
-            proj_norm = self.img_prj_norm
+            proj_norm = np.array(self.img_prj_norm)
 
             n_iter = int(self.tx_ml_num_iter.text())
             filt_sz = int(self.tx_ml_fz.text())
@@ -1453,13 +1518,10 @@ class App(QWidget):
 
 
     def get_proj_from_file(self, fn, attr_proj, attr_flat, attr_dark):
-        with h5py.File(fn, 'r') as hf:
-            img_proj = np.array(hf[attr_proj])
-            img_flat = np.array(hf[attr_flat])
-            img_dark = np.array(hf[attr_dark])
-        img_dark = np.median(img_dark, axis=0, keepdims=True)
-        img_flat = np.median(img_flat, axis=0, keepdims=True)
-        proj_norm = (img_proj-img_dark) / (img_flat - img_dark)
+        with open_scan(fn) as hf:
+            img_proj = h5_array(hf[attr_proj])
+        img_flat, img_dark = load_flat_dark(fn, attr_flat, attr_dark)
+        proj_norm = normalize_proj(img_proj, img_flat, img_dark)
         return proj_norm
 
     def open_prj_file(self):
@@ -1467,9 +1529,14 @@ class App(QWidget):
         file_dict = {}
         options = QFileDialog.Option()
         options |= QFileDialog.DontUseNativeDialog
-        file_type = 'h5 file (*.h5);; TIFF files (*.tiff *.tif)'
-        fn, _ = QFileDialog.getOpenFileName(pytomo, "QFileDialog.getOpenFileName()", "", file_type, options=options)
+        file_type = 'h5 file (*.h5);; scan folder (TIFF / zarr)'
+        fn, file_filter = QFileDialog.getOpenFileName(pytomo, "QFileDialog.getOpenFileName()", "", file_type,
+                                                      options=options)
+        if file_filter.startswith('scan folder'):
+            # TIFF and zarr scans are folders, which the file dialog can not select
+            fn = QFileDialog.getExistingDirectory(pytomo, 'select a TIFF or zarr scan folder', '', options=options)
         if fn:
+            fn = fn.rstrip('/')
             fn_tmp = fn.split('/')
             file_root_path = '/'.join(t for t in fn_tmp[:-1])
 
@@ -1478,8 +1545,8 @@ class App(QWidget):
                 file_prefix = fn_tmp[-1][0]
                 self.tx_prefix.setText(file_prefix)
                 QApplication.processEvents()
-            file_type = '.' + fn_tmp[-1].split('.')[-1]
-            file_loaded = retrieve_file_type(file_root_path, file_prefix, file_type)
+            file_type = '.h5' if os.path.isdir(fn) else '.' + fn_tmp[-1].split('.')[-1]
+            file_loaded = list_scans(file_root_path, file_prefix, self.tx_h5_prj.text(), file_type)
             num = len(file_loaded)
             self.tx_prj_path.setText(file_root_path)
             for i in range(num):
@@ -1489,6 +1556,7 @@ class App(QWidget):
             self.fname_rc.update(file_dict)
             self.file_loaded.append(file_loaded)
             self.update_list()
+            self.index_scan_files(file_loaded)
             if self.lst_prj_file.count() > 0:
                 item = self.lst_prj_file.item(0)
                 self.lst_prj_file.setCurrentItem(item)
@@ -1499,7 +1567,7 @@ class App(QWidget):
         file_prefix = self.tx_prefix.text()
         file_type = '.h5'
         file_root_path = self.tx_prj_path.text().replace(' ', '')
-        file_loaded = retrieve_file_type(file_root_path, file_prefix, file_type)
+        file_loaded = list_scans(file_root_path, file_prefix, self.tx_h5_prj.text(), file_type)
         num = len(file_loaded)
         self.tx_prj_path.setText(file_root_path)
         exist_files = self.fname_rc.keys()
@@ -1512,6 +1580,26 @@ class App(QWidget):
         self.fname_rc = dict(sorted(self.fname_rc.items()))
         self.file_loaded.append(file_loaded)
         self.update_list()
+        self.index_scan_files(file_loaded)
+
+    def index_scan_files(self, files):
+        '''
+        read shape, energy, scan id and angle range of the files in background (see io_util.ScanIndex),
+        they are shown as tooltip of the file list
+        '''
+        try:
+            attrs = (self.tx_h5_prj.text(), self.tx_h5_ang.text(), self.tx_h5_xeng.text(), self.tx_h5_sid.text())
+            if self.scan_index is None or self.scan_index.attrs != attrs:
+                self.scan_index = ScanIndex(None, *attrs)
+            self.scan_index.update(files)
+            self.scan_index_timer.start(500)
+        except Exception as err:
+            print(f'fails to index scan files: {err}')
+
+    def check_scan_index(self):
+        if self.scan_index is None or not self.scan_index.is_running():
+            self.scan_index_timer.stop()
+            self.update_list()
 
     def clear_file_list(self):
         self.fname_rc = {}
@@ -1612,6 +1700,29 @@ class App(QWidget):
             else:
                 txt = fn_short
             item.setText(txt)
+        self.update_list_info()
+
+    def update_list_info(self):
+        if self.scan_index is None:
+            return
+        full_path = {k: os.path.abspath(v['full_path']) for k, v in self.fname_rc.items()}
+        info = self.scan_index.lookup(list(full_path.values()))
+        for i in range(self.lst_prj_file.count()):
+            item = self.lst_prj_file.item(i)
+            fn_short = item.text().split(':')[0]
+            e = info.get(full_path.get(fn_short))
+            if e is None:
+                continue
+            txt = []
+            if e['n_angle'] is not None:
+                txt.append(f"{e['n_angle']} x {e['n_row']} x {e['n_col']}")
+            if e['x_eng'] is not None:
+                txt.append(f"{e['x_eng']:2.4f} keV")
+            if e['scan_id'] is not None:
+                txt.append(f"scan id {e['scan_id']}")
+            if e['angle_start'] is not None:
+                txt.append(f"angle {e['angle_start']:3.1f} ~ {e['angle_end']:3.1f} deg")
+            item.setToolTip(',   '.join(txt) if len(txt) else e['error'])
 
 
     def find_rotation_center_core(self, fn):
@@ -1650,7 +1761,7 @@ class App(QWidget):
             options = {}
             algorithm = self.cb_rc_algorithm.currentText()
             print(algorithm)
-            if algorithm != 'gridrec':               
+            if 'astra' in algorithm:               
  
                 if algorithm == 'astra_fbp':
                     method = 'FBP_CUDA'
@@ -1664,6 +1775,8 @@ class App(QWidget):
                             'num_iter': num_iter,
                             'extra_options': extra_options
                           }
+            elif algorithm in ('sirt', 'cgls'):
+                options = {'num_iter': int(self.tx_rc_algorithm_iter.text())}
                     
 
 
@@ -1678,7 +1791,7 @@ class App(QWidget):
             self.tx_rc_stop.setText(str(stop))
             self.tx_rc_steps.setText(str(steps))
             self.tx_sli_id.setText(str(sli))
-            with h5py.File(fn, 'r') as hf:
+            with open_scan(fn) as hf:
                 self.img_eng = np.array(hf[attr_xeng])
             self.flag_rc = True
         except Exception as err:
@@ -1918,21 +2031,14 @@ class App(QWidget):
         attr_xeng = self.tx_h5_xeng.text()
         attr_sid = self.tx_h5_sid.text()
         sli = int(self.tx_sli_id.text())
-        with h5py.File(fn, 'r') as hf:
+        with open_scan(fn) as hf:
             try:
                 ang = np.array(hf[attr_angle])  # in unit of degrees
                 img0 = np.array(list(hf[attr_proj][0]))
                 s = img0.shape
 
-                img_flat = np.array(hf[attr_flat])
-                if len(img_flat.shape) == 2:
-                    img_flat = np.expand_dims(img_flat, axis=0)
-                img_flat_avg = np.median(img_flat, axis=0)
-
-                img_dark = np.array(hf[attr_dark])
-                if len(img_dark.shape) == 2:
-                    img_dark = np.expand_dims(img_dark, axis=0)
-                img_dark_avg = np.median(img_dark, axis=0)
+                img_flat_avg, img_dark_avg = load_flat_dark(fn, attr_flat, attr_dark)
+                img_flat_avg, img_dark_avg = img_flat_avg[0], img_dark_avg[0]
 
                 if np.abs(ang[0]) < np.abs(ang[0] - 90):  # e.g, rotate from 0 - 180 deg
                     tmp = np.abs(ang - ang[0] - 180).argmin()
@@ -1940,12 +2046,8 @@ class App(QWidget):
                     tmp = np.abs(ang - np.abs(ang[0])).argmin()
                 
                 img180_raw = np.array(list(hf[attr_proj][tmp]))
-                img0 = (img0 - img_dark_avg)/(img_flat_avg - img_dark_avg)
-                img180_raw = (img180_raw - img_dark_avg) / (img_flat_avg - img_dark_avg)
-                im0 = -np.log(img0)
-                im0[np.isnan(im0)] = 0
-                im1 = -np.log(img180_raw[:, ::-1])
-                im1[np.isnan(im1)] = 0
+                im0 = normalize_proj(img0, img_flat_avg, img_dark_avg, log=True)
+                im1 = normalize_proj(img180_raw, img_flat_avg, img_dark_avg, log=True)[:, ::-1]
                 im0 = img_smooth(im0, 3).squeeze()
                 im1 = img_smooth(im1, 3).squeeze()
                 sr = StackReg(StackReg.TRANSLATION)
@@ -2137,11 +2239,11 @@ class App(QWidget):
             attr_proj = self.tx_h5_prj.text()
             attr_flat = self.tx_h5_flat.text()
             attr_dark = self.tx_h5_dark.text()
-            with h5py.File(fn, 'r') as hf:
+            with open_scan(fn) as hf:
                 img_prj = np.array(hf[attr_proj][0])
-                img_flat = np.median(np.array(hf[attr_flat]), axis=0)
-                img_dark = np.median(np.array(hf[attr_dark]), axis=0)
-            img_norm = (img_prj - img_dark) / (img_flat - img_dark)
+            img_flat, img_dark = load_flat_dark(fn, attr_flat, attr_dark)
+            img_flat, img_dark = img_flat[0], img_dark[0]
+            img_norm = normalize_proj(img_prj, img_flat, img_dark)
             plt.figure(figsize=(18, 6))
             plt.subplot(121)
             plt.imshow(img_prj)
@@ -2167,28 +2269,37 @@ class App(QWidget):
         attr_xeng = self.tx_h5_xeng.text()
         attr_sid = self.tx_h5_sid.text()
 
-        with h5py.File(fn, 'r') as hf:
+        with open_scan(fn) as hf:
             try:
-                self.img_prj = np.array(hf[attr_proj])
+                # frames are read from file only when they are shown
+                self.img_prj = LazyProjStack(fn, attr_proj)
                 self.exist_prj = True
             except:
                 self.exist_prj = False
                 self.img_prj = np.zeros((1, 100, 100))
             try:
-                self.img_flat = np.array(hf[attr_flat])
+                ref_flat, ref_dark = load_flat_dark(fn, attr_flat, attr_dark)
+            except:  # e.g. no dark field, each one is loaded alone below
+                ref_flat = ref_dark = None
+            try:
+                self.img_flat = h5_array(hf[attr_flat])
                 if len(self.img_flat.shape) == 2:
                     self.img_flat = np.expand_dims(self.img_flat, axis=0)
-                self.img_flat_avg = np.median(self.img_flat, axis=0, keepdims=True)
+                if ref_flat is None:
+                    ref_flat = load_flat_dark(fn, attr_flat, None)[0]
+                self.img_flat_avg = ref_flat
                 self.exist_flat = True
             except:
                 self.exist_flat = False
                 self.img_flat = 1
                 self.img_flat_avg = 1
             try:
-                self.img_dark = np.array(hf[attr_dark])
+                self.img_dark = h5_array(hf[attr_dark])
                 if len(self.img_dark.shape) == 2:
                     self.img_dark = np.expand_dims(self.img_dark, axis=0)
-                self.img_dark_avg = np.median(self.img_dark, axis=0, keepdims=True)
+                if ref_dark is None:
+                    ref_dark = load_flat_dark(fn, None, attr_dark)[1]
+                self.img_dark_avg = ref_dark
                 self.exist_dark = True
             except:
                 self.img_dark = 0
@@ -2199,7 +2310,7 @@ class App(QWidget):
             except:
                 self.img_angle = []
             if self.exist_prj:
-                self.img_prj_norm = (self.img_prj - self.img_dark_avg) / (self.img_flat_avg - self.img_dark_avg)
+                self.img_prj_norm = LazyProjStack(fn, attr_proj, self.img_flat_avg, self.img_dark_avg)
                 self.exist_prj_norm = True
             else:
                 self.img_prj_norm = np.zeros((1, 100, 100))
@@ -2215,7 +2326,7 @@ class App(QWidget):
 
 
 
-    def recon_single_file_slices(self, fn, sli, fsave_flag, fsave_root, fsave_prefix, return_flag):
+    def recon_single_file_slices(self, fn, sli, fsave_flag, fsave_root, fsave_prefix, return_flag, proj_reader=None):
         attr_proj = self.tx_h5_prj.text()
         attr_flat = self.tx_h5_flat.text()
         attr_dark = self.tx_h5_dark.text()
@@ -2229,7 +2340,7 @@ class App(QWidget):
         binning = int(self.tx_rec_bin.text())
         algorithm = self.cb_rc_algorithm.currentText()
         options = {}
-        if algorithm != 'gridrec':               
+        if 'astra' in algorithm:               
             if algorithm == 'astra_fbp':
                 method = 'FBP_CUDA'
             elif algorithm == 'astra_sirt':
@@ -2242,6 +2353,8 @@ class App(QWidget):
                         'num_iter': num_iter,
                         'extra_options': extra_options
                       }
+        elif algorithm in ('sirt', 'cgls'):
+            options = {'num_iter': int(self.tx_rc_algorithm_iter.text())}
 
         p = int(self.tx_rc_ring_remove.text())
         if self.cb_rm_strip.currentText() == 'wavelet':
@@ -2256,8 +2369,12 @@ class App(QWidget):
         roi_s = self.tx_rec_roi_s.text()
         roi_s = extract_range(roi_s, 'int')
         mask_r = float(self.tx_rec_cir_mask_ratio.text())
-               
-        
+        fsave_quantize = self.cb_rec_save_type.currentText()
+        fsave_compression = self.cb_rec_compress.currentText()
+        fsave_compression = None if fsave_compression == 'None' else fsave_compression
+        fsave_incremental = fsave_flag and self.chkbox_rec_incremental.isChecked()
+        fsave_format = self.cb_rec_format.currentText()
+
         fn_short = fn.split('/')[-1]
         rc, recon_flag = self.check_fname_rc_states(fn_short)
         if rc == 0:
@@ -2275,11 +2392,16 @@ class App(QWidget):
                        fsave_flag=fsave_flag,
                        fsave_root=fsave_root,
                        fsave_prefix=fsave_prefix,
+                       fsave_compression=fsave_compression,
+                       fsave_quantize=fsave_quantize,
+                       fsave_incremental=fsave_incremental,
+                       fsave_format=fsave_format,
                        roi_cen=roi_c,
                        roi_size=roi_s,
                        return_flag=return_flag,
                        ml_param=ml_param,
-                       auto_block_list=auto_block_list
+                       auto_block_list=auto_block_list,
+                       proj_reader=proj_reader
                        )
         if return_flag:
             return rec, fsave, rc
@@ -2351,7 +2473,7 @@ class App(QWidget):
 
 
 
-    def recon_single_file_core(self, fn):
+    def recon_single_file_core(self, fn, proj_reader=None):
         sli = self.tx_rec_sli.text()
         sli = extract_range(sli, 'int')
         tx = fn.split('/')
@@ -2361,9 +2483,30 @@ class App(QWidget):
         fsave_flag = True
 
         rec, fsave, rc = self.recon_single_file_slices(fn, sli, fsave_flag, fsave_root,
-                                                                     fsave_prefix, return_flag=True)
+                                                                     fsave_prefix, return_flag=True,
+                                                                     proj_reader=proj_reader)
         return rec, fsave, rc
 
+    def prefetch_proj_file(self, fn):
+        '''
+        start loading and normalizing fn in background, with the same settings as recon_single_file_core
+        '''
+        if len(self.ml_get_param()):  # ml denoise needs the full projection stack, no streaming
+            return None
+        try:
+            attr_proj = self.tx_h5_prj.text()
+            attr_flat = self.tx_h5_flat.text()
+            attr_dark = self.tx_h5_dark.text()
+            sli = extract_range(self.tx_rec_sli.text(), 'int')
+            binning = int(self.tx_rec_bin.text())
+            dark_scale = int(self.tx_rc_dark_scale.text())
+            proj_reader = ProjBlockReader(fn, attr_proj, attr_flat, attr_dark, sli, dark_scale, binning=binning)
+            proj_reader.prefetch(self.prefetch_mem)
+            return proj_reader
+        except Exception as err:
+            print(f'fails to prefetch {fn}: {err}')
+            return None
+
     def set_single_selection(self):
         self.msg = 'Uncheck "Enable multi-selection", and then select the file to reconstruct'
         self.update_msg()
@@ -2407,6 +2550,8 @@ class App(QWidget):
             if plot_flag:
                 #if exist_napari and self.chkbox_napari.isChecked():
                 #    napari.view_image(self.img_rec_tomo)
+                if self.img_rec_tomo is None:  # written to file by chunk
+                    self.img_rec_tomo = load_recon(fsave)
                 fsave_short = fsave.split('/')[-1]
                 sup_title = fsave_short
                 self.canvas1.sup_title = sup_title
@@ -2430,6 +2575,8 @@ class App(QWidget):
         try:
             items = self.lst_prj_file.selectedItems()
             n_list = len(items)
+            fn_list = [self.fname_rc[item.text().split(':')[0]]['full_path'] for item in items]
+            proj_reader_next = None
             for i in range(n_list):
                 try:
                     tx = items[i].text()
@@ -2440,7 +2587,12 @@ class App(QWidget):
                     self.update_msg()
                     items[i].setText(tx + '  <--')
                     QApplication.processEvents()
-                    rec, fsave, rc = self.recon_single_file_core(fn)
+                    # load next file in background while reconstructing the current one
+                    proj_reader = proj_reader_next
+                    proj_reader_next = None
+                    if i + 1 < n_list:
+                        proj_reader_next = self.prefetch_proj_file(fn_list[i + 1])
+                    rec, fsave, rc = self.recon_single_file_core(fn, proj_reader)
                     items[i].setText(tx)
                     recon_flag = f'Y: {fsave}'
                     self.update_fname_rc(fn_short, rc, recon_flag)
@@ -2484,9 +2636,8 @@ class App(QWidget):
             print(fn_recon)
             if file_type == 'tiff' or file_type == 'tif':
                 self.img_rec_tomo = io.imread(fn_recon)
-            elif file_type == 'h5':
-                with h5py.File(fn_recon, 'r') as hf:
-                    self.img_rec_tomo = np.array(hf['img'])
+            elif file_type == 'h5' or file_type == 'zarr':
+                self.img_rec_tomo = load_recon(fn_recon)
             else:
                 self.msg = 'fail in loading image file'
                 self.update_msg()
@@ -2589,9 +2740,8 @@ class App(QWidget):
             file_type = fn_recon.split('.')[-1]
             if file_type == 'tiff' or file_type == 'tif':
                 img_rec_tomo = io.imread(fn_recon)
-            elif file_type == 'h5':
-                with h5py.File(fn_recon, 'r') as hf:
-                    img_rec_tomo = np.array(hf['img'])
+            elif file_type == 'h5' or file_type == 'zarr':
+                img_rec_tomo = load_recon(fn_recon)
             return img_rec_tomo, fn_short
         else:
             return None, None
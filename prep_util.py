@@ -0,0 +1,311 @@
+import os
+import queue
+import threading
+import numpy as np
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
+try:
+    import pywt
+    exist_pywt = True
+except ImportError:
+    exist_pywt = False
+
+
+thread_pool = None
+thread_pool_lock = threading.Lock()
+tile_size = 256 * 1024  # pixels processed per ufunc call, small enough to stay in cache
+
+
+def get_thread_pool(n_thread=None):
+    '''
+    persistent pool of threads for numpy work (ufuncs release the GIL), created once per process with at least
+    os.cpu_count() threads. It is never re-created, as other threads (e.g. pipeline()) may be submitting to it
+    '''
+    global thread_pool
+    with thread_pool_lock:
+        if thread_pool is None:
+            thread_pool = ThreadPoolExecutor(max_workers=max(n_thread or 1, os.cpu_count() or 1))
+    return thread_pool
+
+
+def run_blocks(func, n, n_thread=None):
+    '''
+    call func(i_s, i_e) on pieces of range(n), using n_thread threads
+    '''
+    n_thread = n_thread or os.cpu_count() or 1
+    n_part = min(n, n_thread * 4)
+    if n_thread == 1 or n_part < 2:
+        func(0, n)
+        return
+    bound = np.linspace(0, n, n_part + 1).astype(int)
+
+    def run_parts(j):  # at most n_thread of these run at once, whatever the size of the pool
+        for i in range(j, n_part, n_thread):
+            func(bound[i], bound[i+1])
+
+    futures = [get_thread_pool(n_thread).submit(run_parts, j) for j in range(min(n_thread, n_part))]
+    for f in futures:
+        f.result()
+
+
+def normalize_proj(img, flat, dark, out=None, log=False, dtype=np.float32, n_thread=None):
+    '''
+    (img - dark) / (flat - dark) in a single pass over small tiles, shared by n_thread threads.
+    nan, inf and negative values are set to 0.
+    With log=True, -log() is applied in the same pass, and values that end up nan, inf or < 0 are set to 0.
+
+    img: projection (n_row, n_col) or stack (n_angle, n_row, n_col), of any dtype
+    flat, dark: broadcastable to (n_row, n_col), e.g. (1, n_row, n_col) from load_flat_dark(),
+                dark already divided by dark_scale
+    out: preallocated float array with the shape of img, can be img itself. Allocated with dtype if None
+    '''
+    if out is None:
+        out = np.empty(img.shape, dtype=dtype)
+    s = img.shape[-2:]
+    dark = np.broadcast_to(np.asarray(dark, dtype=out.dtype).reshape(np.shape(dark)[-2:]), s)
+    denom = np.broadcast_to(np.asarray(flat, dtype=out.dtype).reshape(np.shape(flat)[-2:]) - dark, s)
+    img3 = img[np.newaxis] if img.ndim == 2 else img
+    out3 = out[np.newaxis] if out.ndim == 2 else out
+    n_row_tile = max(1, tile_size // max(s[1], 1))
+
+    def norm_block(i_s, i_e):
+        with np.errstate(divide='ignore', invalid='ignore'):
+            for i in range(i_s, i_e):
+                for r_s in range(0, s[0], n_row_tile):
+                    r_e = min(r_s + n_row_tile, s[0])
+                    o = out3[i, r_s:r_e]
+                    np.subtract(img3[i, r_s:r_e], dark[r_s:r_e], out=o)
+                    np.divide(o, denom[r_s:r_e], out=o)
+                    clean_tile(o, log)
+
+    run_blocks(norm_block, img3.shape[0], n_thread)
+    return out
+
+
+def neg_log(img, out=None, n_thread=None):
+    '''
+    -log(img) with nan, inf and negative results set to 0, in a single threaded pass. out can be img itself.
+    img: (n_row, n_col) or (n_angle, n_row, n_col)
+    '''
+    if out is None:
+        out = np.empty(img.shape, dtype=img.dtype if img.dtype.kind == 'f' else np.float32)
+    s = img.shape[-2:]
+    img3 = img[np.newaxis] if img.ndim == 2 else img
+    out3 = out[np.newaxis] if out.ndim == 2 else out
+    n_row_tile = max(1, tile_size // max(s[1], 1))
+
+    def log_block(i_s, i_e):
+        with np.errstate(divide='ignore', invalid='ignore'):
+            for i in range(i_s, i_e):
+                for r_s in range(0, s[0], n_row_tile):
+                    o = out3[i, r_s:r_s + n_row_tile]
+                    np.log(img3[i, r_s:r_s + n_row_tile], out=o)
+                    np.negative(o, out=o)
+                    clean_tile(o)
+
+    run_blocks(log_block, img3.shape[0], n_thread)
+    return out
+
+
+def clean_proj(img, n_thread=None):
+    '''
+    set nan, inf and negative values of img (n_row, n_col) or (n_angle, n_row, n_col) to 0, in place
+    '''
+    img3 = img[np.newaxis] if img.ndim == 2 else img
+    n_row_tile = max(1, tile_size // max(img.shape[-1], 1))
+
+    def clean_block(i_s, i_e):
+        for i in range(i_s, i_e):
+            for r_s in range(0, img3.shape[1], n_row_tile):
+                clean_tile(img3[i, r_s:r_s + n_row_tile])
+
+    run_blocks(clean_block, img3.shape[0], n_thread)
+    return img
+
+
+def clean_tile(o, log=False):
+    if log:
+        np.log(o, out=o)
+        np.negative(o, out=o)
+    np.copyto(o, 0, where=~((o >= 0) & (o < np.inf)))
+
+
+def pipeline(items, func, n_ahead=1):
+    '''
+    yield func(item) for each item, computed by a background thread that works at most n_ahead results ahead of
+    the consumer, so preparing the next item overlaps with processing the current one.
+    An exception in func is raised in the consumer.
+    Closing the generator early stops the thread after the item it is working on, and drops the results it
+    computed ahead
+    '''
+    q = queue.Queue(maxsize=max(1, n_ahead))
+    stop = threading.Event()
+
+    def put(msg):
+        while not stop.is_set():
+            try:
+                q.put(msg, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def run():
+        try:
+            for item in items:
+                if not put(('item', func(item))):
+                    return
+            put(('done', None))
+        except BaseException as err:
+            put(('error', err))
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    try:
+        while True:
+            kind, res = q.get()
+            if kind == 'done':
+                break
+            if kind == 'error':
+                raise res
+            yield res
+    finally:
+        stop.set()
+        thread.join()
+        while not q.empty():  # free the results computed ahead
+            q.get_nowait()
+
+
+def bin_proj(img, binning=1):
+    '''
+    mean over binning x binning pixels of each projection of img (n_angle, n_row, n_col),
+    rows and columns that don't fill a whole bin at the end are dropped
+    '''
+    if binning == 1:
+        return img
+    n, r, c = img.shape[0], img.shape[1] // binning, img.shape[2] // binning
+    img = img[:, :r * binning, :c * binning].reshape(n, r, binning, c, binning)
+    return img.mean(-1).mean(-2)
+
+
+ref_mem_limit = 512 * 2**20  # bytes of flat/dark frames held at once by reduce_frames()
+
+
+def reduce_frames(ds, method='median', trim=0.1, mem_limit=None, n_thread=None):
+    '''
+    Per-pixel median (method='median') or trimmed mean (method='trim_mean') over the frames of a flat or dark stack,
+    returned as float32 with shape (1, n_row, n_col).
+    trim_mean drops the lowest and highest "trim" fraction of the frames at each pixel before averaging.
+
+    ds: (n_frame, n_row, n_col) or (n_row, n_col), an array or any dataset that supports ds[:, r_s:r_e]
+        (h5py, zarr, np.memmap from h5_memmap(), TiffStack)
+    If the stack is larger than mem_limit bytes, it is read and reduced in row tiles (aligned with the dataset chunks)
+    by n_thread threads holding about mem_limit bytes of tiles at once, so hundreds of frames are never loaded
+    together, nor converted to float64. Smaller stacks are read in one piece and reduced by row tiles in parallel.
+    '''
+    if method not in ('median', 'trim_mean'):
+        raise ValueError(f'unknown method "{method}", use "median" or "trim_mean"')
+    if len(ds.shape) == 2:
+        return np.asarray(ds[:], dtype=np.float32)[np.newaxis]
+    n_frame, n_row, n_col = ds.shape
+    n_thread = n_thread or os.cpu_count() or 1
+    mem_limit = mem_limit or ref_mem_limit
+    out = np.empty((1, n_row, n_col), dtype=np.float32)
+    if n_frame * n_row * n_col == 0:
+        out[:] = np.nan
+        return out
+
+    row_bytes = n_frame * n_col * np.dtype(ds.dtype).itemsize
+    in_memory = row_bytes * n_row <= mem_limit
+    if in_memory:  # read once, then reduce row tiles of the in-memory copy in parallel
+        src = np.asarray(ds[:])
+        if not src.flags.owndata or not src.flags.writeable:
+            src = src.copy()
+        n_row_tile = -(-n_row // (n_thread * 4))
+    else:
+        src = ds
+        n_row_tile = max(1, mem_limit // n_thread // row_bytes)
+        chunks = getattr(ds, 'chunks', None)
+        if chunks and len(chunks) == 3 and chunks[1] < n_row:
+            n_row_tile = max(chunks[1], n_row_tile // chunks[1] * chunks[1])
+    tiles = list(range(0, n_row, n_row_tile))
+    lo = int(n_frame * trim)
+    hi = max(n_frame - lo, lo + 1)
+
+    def reduce_block(i_s, i_e):
+        for r_s in tiles[i_s:i_e]:
+            r_e = min(r_s + n_row_tile, n_row)
+            tile = src[:, r_s:r_e]
+            if not in_memory:
+                tile = np.asarray(tile)
+                if not tile.flags.owndata or not tile.flags.writeable:
+                    tile = tile.copy()
+            if method == 'median':
+                out[0, r_s:r_e] = np.median(tile, axis=0, overwrite_input=True)
+            else:
+                if n_frame > 2:
+                    tile.partition(sorted({lo, hi - 1}), axis=0)
+                out[0, r_s:r_e] = np.mean(tile[lo:hi], axis=0, dtype=np.float64)
+
+    run_blocks(reduce_block, len(tiles), min(n_thread, len(tiles)))
+    return out
+
+
+def remove_stripe_fw(prj, level=None, wname='db5', sigma=2, pad=True, n_thread=None):
+    '''
+    Wavelet-Fourier stripe removal (Munch et al., Opt. Express 17, 8567 (2009)), same result as
+    tomopy.prep.stripe.remove_stripe_fw, but each thread filters a group of sinograms with one batched
+    wavelet decomposition and FFT, instead of looping over sinograms.
+
+    prj: (n_angle, n_row, n_col) or a single sinogram (n_angle, n_col). Returns a new float32 array
+    '''
+    if not exist_pywt:
+        raise ImportError('PyWavelets (pywt) is needed for remove_stripe_fw')
+    sino = np.asarray(prj, dtype=np.float32)
+    if sino.ndim == 2:
+        return remove_stripe_fw(sino[:, np.newaxis], level, wname, sigma, pad, n_thread)[:, 0]
+    if level is None:
+        level = int(np.ceil(np.log2(max(sino.shape))))
+    n_angle, n_row, n_col = sino.shape
+    nx = n_angle + n_angle // 8 if pad else n_angle
+    xshift = (nx - n_angle) // 2
+    damp = fw_damping(nx, level, wname, sigma)
+    out = np.empty(sino.shape, dtype=np.float32)
+    n_group = max(1, tile_size * 16 // (nx * n_col))  # sinograms per batch
+
+    def fw_block(i_s, i_e):
+        for g_s in range(i_s * n_group, min(i_e * n_group, n_row), n_group):
+            g_e = min(g_s + n_group, n_row)
+            sli = np.zeros((g_e - g_s, nx, n_col), dtype=np.float32)
+            sli[:, xshift:xshift + n_angle] = sino[:, g_s:g_e].transpose(1, 0, 2)
+            coeff = []
+            for n in range(level):
+                sli, (cH, cV, cD) = pywt.dwt2(sli, wname)
+                fcV = np.fft.fft(cV, axis=1)
+                fcV *= damp[n]
+                coeff.append((cH, np.real(np.fft.ifft(fcV, axis=1)), cD))
+            for n in range(level)[::-1]:
+                cH = coeff[n][0]
+                sli = sli[:, :cH.shape[1], :cH.shape[2]]
+                sli = pywt.idwt2((sli, coeff[n]), wname)
+            out[:, g_s:g_e] = sli[:, xshift:xshift + n_angle, :n_col].transpose(1, 0, 2)
+
+    run_blocks(fw_block, -(-n_row // n_group), n_thread)
+    return out
+
+
+@lru_cache(maxsize=32)
+def fw_damping(nx, level, wname, sigma):
+    '''
+    Gaussian damping of the low vertical frequencies of the cV band at each level of remove_stripe_fw(),
+    in unshifted FFT order with shape (my, 1), cached per padded sinogram height nx, level, wavelet and sigma
+    '''
+    damp = []
+    dec_len = pywt.Wavelet(wname).dec_len
+    my = nx
+    for n in range(level):
+        my = pywt.dwt_coeff_len(my, dec_len, 'symmetric')
+        y_hat = (np.arange(-my, my, 2, dtype=np.float32) + 1) / 2
+        d = -np.expm1(-np.square(y_hat) / (2 * np.square(sigma)))
+        damp.append(np.fft.ifftshift(d)[:, np.newaxis])
+    return damp
@@ -1,12 +1,17 @@
 import tomopy
 import numpy as np
 import h5py
+import os
+import json
 import time
 from tqdm import tqdm, trange
 import skimage.restoration as skr
 from skimage.filters import gaussian as gf
 from scipy.signal import correlate
 from scipy.interpolate import UnivariateSpline
+from io_util import *
+from prep_util import *
+from recon_util import *
 try:
     from pyxas_util import *
     import pyxas
@@ -23,6 +28,8 @@ except:
     algotom_exist = False
     print('algotom not found')    
 
+denoise_rows = 40  # rows per piece of the post -log denoise in recon_img
+
 
 def find_cen(fn):
     img, cen = test_center(fn, print_flag=0, circ_mask_ratio=0.8)
@@ -85,7 +92,7 @@ def test_center(
 ):
     import tomopy
     
-    f = h5py.File(fn, "r")
+    f = open_scan(fn)
     tmp = np.array(f["img_tomo"][0])
     s = [1, tmp.shape[0], tmp.shape[1]]
 
@@ -99,15 +106,10 @@ def test_center(
 
     img_bkg = np.array(f["img_bkg_avg"][:, sli:sli+1, :])
     img_dark = np.array(f["img_dark_avg"][:, sli:sli+1, :]) / dark_scale
-    prj = (img_tomo - img_dark) / (img_bkg - img_dark)
-    prj_norm = -np.log(prj)
+    prj_norm = normalize_proj(img_tomo, img_bkg, img_dark, log=True)
     f.close()
 
-    prj_norm[np.isnan(prj_norm)] = 0
-    prj_norm[np.isinf(prj_norm)] = 0
-    prj_norm[prj_norm < 0] = 0
-
-    prj_norm = tomopy.prep.stripe.remove_stripe_fw(prj_norm, level=fw_level, wname="db5", sigma=1, pad=True)
+    prj_norm = remove_stripe_fw(prj_norm, level=fw_level, wname="db5", sigma=1, pad=True)
 
     #prj_norm = tomopy.prep.stripe.remove_all_stripe(prj_norm, snr=snr)
    
@@ -230,9 +232,10 @@ def rotcen_test(fn,
                 fw_level=9,
                 filter_name='None',
                 ml_param = {},
-                auto_block_list = {}
+                auto_block_list = {},
+                dtype = np.float32,
                 ):
-    f = h5py.File(fn, "r")
+    f = open_scan(fn)
     tmp = np.array(f[attr_proj][0])
     s = [1, tmp.shape[0], tmp.shape[1]]
 
@@ -249,17 +252,11 @@ def rotcen_test(fn,
     ]
 
     theta = np.array(f[attr_angle]) / 180.0 * np.pi
-    img_tomo = np.array(f[attr_proj][:, sli_exp[0]: sli_exp[1], :])
-
-    img_dark = np.array(f[attr_dark][:, sli_exp[0]: sli_exp[1], :])
-    img_dark = np.median(img_dark, axis=0, keepdims=True)
-
-    img_bkg = np.array(f[attr_flat][:, sli_exp[0]: sli_exp[1], :])
-    img_bkg = np.median(img_bkg, axis=0, keepdims=True)
+    img_tomo = np.array(h5_memmap(f[attr_proj])[:, sli_exp[0]: sli_exp[1], :], dtype=dtype)
     f.close()
 
-    prj_norm = (img_tomo - img_dark / dark_scale) / (img_bkg - img_dark / dark_scale)
-    prj_norm[np.isnan(prj_norm)] = 0
+    img_bkg, img_dark = load_flat_dark(fn, attr_flat, attr_dark, dark_scale, rows=sli_exp)
+    prj_norm = normalize_proj(img_tomo, img_bkg, img_dark, out=img_tomo)
     prj_norm = ml_denoise(prj_norm, ml_param)
 
     n_angle = len(theta)
@@ -274,11 +271,9 @@ def rotcen_test(fn,
     prj_norm = prj_norm[idx]
     theta = theta[idx]
 
-    prj_norm = -np.log(prj_norm)
-    prj_norm = denoise(prj_norm, denoise_flag)
-    prj_norm[np.isnan(prj_norm)] = 0
-    prj_norm[np.isinf(prj_norm)] = 0
-    prj_norm[prj_norm < 0] = 0
+    prj_norm = neg_log(prj_norm, out=prj_norm)
+    if denoise_flag:
+        prj_norm = clean_proj(denoise(prj_norm, denoise_flag))
 
     s = prj_norm.shape
     if len(s) == 2:
@@ -307,62 +302,44 @@ def rotcen_test(fn,
             print('remove all_strip using tomopy')
         
     if fw_level > 0:
-        prj_norm = tomopy.prep.stripe.remove_stripe_fw(prj_norm, level=fw_level)
+        prj_norm = remove_stripe_fw(prj_norm, level=fw_level)
 
     if sli_start <= 0:
         sli_start = int(s[2] / 2 - 30)
         sli_stop = int(s[2] / 2 + 30)
         sli_steps = 30
     cen = np.linspace(sli_start, sli_stop, sli_steps, endpoint=False)
-    img = np.zeros([len(cen), s[2], s[2]])
-    for i in range(len(cen)):
-        if 1:
-            print("{}: rotcen {}".format(i + 1, cen[i]))
-            if algorithm == 'gridrec':
-                if algotom_exist:
-                    t = algotom_rec.gridrec_reconstruction(
-                        prj_norm[:, addition_slice // 2: addition_slice // 2 + 1],
-                        cen[i],
-                        theta,
-                        filter_name=filter_name,
-                        apply_log=False
-                    )
-                    img[i] = np.squeeze(t)
-                else:
-                    img[i] = tomopy.recon(
-                        prj_norm[:, addition_slice // 2: addition_slice // 2 + 1],
-                        theta,
-                        center=cen[i],
-                        algorithm="gridrec",
-                        filter_name=filter_name
-                    )
-            elif 'astra' in algorithm:
-                try:
-                    img[i] = tomopy.recon(
-                        prj_norm[:, addition_slice // 2: addition_slice // 2 + 1],
-                        theta,
-                        center=cen[i],
-                        algorithm=tomopy.astra,
-                        options=options
-                    )
-                except:
-                    print(f'astra_cuda is not available, switch to gridrec')
-                    img[i] = tomopy.recon(
-                        prj_norm[:, addition_slice // 2: addition_slice // 2 + 1],
-                        theta,
-                        center=cen[i],
-                        algorithm="gridrec",
-                        filter_name=filter_name
-                    )
+    # shift the sinogram so that every candidate center moves to cen0, and reconstruct all of them at once
+    cen0 = float(np.round(np.mean(cen)))
+    prj_cen = shift_sino(prj_norm[:, addition_slice // 2], cen - cen0)
+    print(f'reconstruct {len(cen)} rotation centers from {cen[0]} to {cen[-1]}')
+    if algorithm in ('sirt', 'cgls') and not system_matrix_fits(len(theta), prj_cen.shape[2]):
+        print(f'{algorithm} needs a larger binning at {prj_cen.shape[2]} columns, switch to fbp')
+        algorithm = 'fbp'
+    if algorithm == 'gridrec':
+        if algotom_exist:
+            img = algotom_rec.gridrec_reconstruction(prj_cen, cen0, theta, filter_name=filter_name, apply_log=False)
+            img = np.swapaxes(img, 0, 1)
+        else:
+            img = tomopy.recon(prj_cen, theta, center=cen0, algorithm="gridrec", filter_name=filter_name)
+    elif algorithm == 'fbp':
+        img = fbp_recon(prj_cen, theta, cen0, filter_name)
+    elif algorithm in ('sirt', 'cgls'):
+        img = iter_recon(prj_cen, theta, cen0, algorithm, n_iter=options.get('num_iter', n_iter))
+    elif 'astra' in algorithm:
+        try:
+            img = tomopy.recon(prj_cen, theta, center=cen0, algorithm=tomopy.astra, options=options)
+        except:
+            if algorithm == 'astra_sirt' and system_matrix_fits(len(theta), prj_cen.shape[2]):
+                print('astra_cuda is not available, switch to sirt on cpu')
+                img = iter_recon(prj_cen, theta, cen0, 'sirt', n_iter=options.get('num_iter', n_iter),
+                                 min_constraint=0)
             else:
-                img[i] = tomopy.recon(
-                    prj_norm[:, addition_slice // 2: addition_slice // 2 + 1],
-                    theta,
-                    center=cen[i],
-                    algorithm=algorithm,
-                    num_iter=n_iter,
-                    # filter_name=filter_name
-                )
+                print('astra_cuda is not available, switch to gridrec')
+                img = tomopy.recon(prj_cen, theta, center=cen0, algorithm="gridrec", filter_name=filter_name)
+    else:
+        img = tomopy.recon(prj_cen, theta, center=cen0, algorithm=algorithm, num_iter=n_iter)
+    img = np.asarray(img, dtype=dtype)
     img = tomopy.circ_mask(img, axis=0, ratio=circ_mask_ratio)
     return img, cen, sli_start, sli_stop, sli_steps, sli
 
@@ -388,14 +365,43 @@ def recon_and_save(fn,
                   fsave_flag = True,
                   fsave_root = '.',
                   fsave_prefix = '',
+                  fsave_compression = None,
+                  fsave_quantize = None,
+                  fsave_incremental = False,
+                  fsave_resume = True,
+                  fsave_format = 'h5',
                   roi_cen = [],
                   roi_size = [],
                   return_flag = True,
                   ml_param = {},
                   auto_block_list = {},
+                  stream_flag = True,
+                  dtype = np.float32,
+                  proj_reader = None,
+                  preview = 1,
+                  n_sli = None,
                   ):
+    '''
+    fsave_compression: None, 'gzip' or 'lzf'
+    fsave_quantize: None (keep dtype), 'float32' or 'uint16', see io_util.quantize_img()
+    fsave_incremental: if True (and fsave_flag), each reconstructed chunk is masked, cropped and written
+                       to file as soon as it is produced, and the returned rec is None
+    fsave_resume: with fsave_incremental, if the file was left unfinished by an earlier run with identical
+                  parameters, only the missing chunks are reconstructed
+    fsave_format: 'h5' or 'zarr'. A zarr store (directory "recon_....zarr") is always written by chunk
+                  from parallel threads, and the returned rec is None, see io_util.ReconZarrWriter
+    proj_reader: optional ProjBlockReader of fn, e.g. one that already prefetched data in background.
+                 It is used if it matches the slice range, dark_scale and dtype of this reconstruction
+    preview: if > 1, quick-look reconstruction from every preview-th projection only (read as strided
+             hyperslabs), saved with suffix "_preview_{preview}". The expected time of the full
+             reconstruction is printed at the end
+    n_sli: number of (binned) slices reconstructed together. None chooses it from the available memory,
+           the projection size and the core count, see io_util.recon_chunk_size()
+    '''
+    ts0 = time.time()
+    preview = max(int(preview), 1)
     print('Loading imaging data ... ')
-    f = h5py.File(fn, "r")
+    f = open_scan(fn)
     tmp_tomo = np.array(f[attr_proj][0:1])
 
     slice_info = ""
@@ -412,36 +418,37 @@ def recon_and_save(fn,
         slice_info = f"_slice_{sli[0]}_{sli[1]}"
     else:
         print("non valid slice id, will take reconstruction for the whole object")
-    img_tomo = np.array(f[attr_proj][:, sli[0]:sli[1]])
 
     xeng = np.array(f[attr_xeng]) if attr_xeng in f else 0
     scan_id = np.array(f[attr_sid]) if attr_sid in f else 0
-    angle_list = np.array(f[attr_angle])
-
-    img_dark = np.array(f[attr_dark][:, sli[0]:sli[1]])
-    if len(img_dark.shape) == 3:
-        img_dark = np.median(img_dark, axis=0, keepdims=True)
-    img_bkg = np.array(f[attr_flat][:, sli[0]:sli[1]])
-    if len(img_bkg.shape) == 3:
-        img_bkg = np.median(img_bkg, axis=0, keepdims=True)
-    f.close()
-
-    proj0 = (img_tomo - img_dark / dark_scale) / (img_bkg - img_dark / dark_scale)
-    proj0[np.isinf(proj0)] = 0
-    proj0[np.isnan(proj0)] = 0
-    proj0[proj0<0] = 0
-    rec = recon_img(proj0, angle_list, rot_cen, binning, block_list,
-                    denoise_flag, snr, fw_level, algorithm, options, circ_mask_ratio,
-                    ml_param, auto_block_list)
-    s1 = rec.shape # (400, 1280, 1280)
-    if len(roi_cen) == 2 and len(roi_size) == 2:
-        roi_cen = np.array(roi_cen) // binning
-        roi_size = np.array(roi_size) // binning
-        r_s = max(0, int(roi_cen[0]-roi_size[0]/2))
-        r_e = min(s1[1], r_s + int(roi_size[0]))
-        c_s = max(0, int(roi_cen[1] - roi_size[1] / 2))
-        c_e = min(s1[2], c_s + int(roi_size[1]))
-        rec = rec[:, r_s:r_e, c_s:c_e]
+    angle_list = np.array(f[attr_angle])[::preview]
+    if preview > 1:
+        # block_list is given in index of the full angle list
+        block_list = [i // preview for i in block_list if i % preview == 0]
+        slice_info += f"_preview_{preview}"
+
+    # ml_denoise works on whole projection images, so it needs the full stack in memory
+    stream_flag = stream_flag and not (exist_pyxas and len(ml_param))
+    if stream_flag:
+        f.close()
+        if n_sli is None and proj_reader is not None:  # keep the blocks it already read ahead
+            n_sli = max(1, proj_reader.n_sli // binning)
+        proj0 = ProjBlockReader(fn, attr_proj, attr_flat, attr_dark, sli, dark_scale,
+                                n_sli=None if n_sli is None else n_sli * binning, dtype=dtype,
+                                angle_step=preview, binning=binning)
+        if proj_reader is not None and proj_reader.key == proj0.key:
+            proj0 = proj_reader
+    else:
+        if preview > 1:
+            img_tomo = np.array(f[attr_proj][::preview, sli[0]:sli[1]], dtype=dtype)
+            f.close()
+        else:
+            f.close()
+            img_tomo = read_scan_parallel(fn, attr_proj, sli, dtype=dtype)
+        img_bkg, img_dark = load_flat_dark(fn, attr_flat, attr_dark, dark_scale)
+        proj0 = normalize_proj(img_tomo, img_bkg[:, sli[0]:sli[1]], img_dark[:, sli[0]:sli[1]], out=img_tomo)
+    if proj_reader is not None and not proj0 is proj_reader:
+        proj_reader.stop_prefetch()
 
     if len(fsave_prefix) == 0:
         tmp = fn.split('/')[-1]
@@ -450,58 +457,128 @@ def recon_and_save(fn,
         fsave_prefix = tmp1 if len(tmp1) else tmp
     if fsave_root[-1] == '/':
         fsave_root = fsave_root[:-1]
-    fsave = f"{fsave_root}/recon_{fsave_prefix}{slice_info}{bin_info}.h5"
-    
-    if fsave_flag:
-        ts1 = time.time()
-        print('saving data ...')
-        with h5py.File(fsave, "w") as hf:
-            hf.create_dataset("img", data=rec)
-            hf.create_dataset("rot_cen", data=rot_cen)
-            hf.create_dataset("binning", data=binning)
-            hf.create_dataset("scan_id", data=scan_id)
-            hf.create_dataset("X_eng", data=xeng)
-        ts2 = time.time()
+    fsave = f"{fsave_root}/recon_{fsave_prefix}{slice_info}{bin_info}.{fsave_format}"
+
+    n_row = proj0.n_row if stream_flag else proj0.shape[1]
+    s1 = (n_row // binning, s[2] // binning, s[2] // binning) # (400, 1280, 1280)
+    roi = roi_range(roi_cen, roi_size, binning, s1)
+    meta = {'rot_cen': rot_cen, 'binning': binning, 'scan_id': scan_id, 'X_eng': xeng}
+
+    writer = None
+    if fsave_flag and (fsave_incremental or fsave_format == 'zarr'):
+        param = recon_param_str(fn=os.path.abspath(fn), mtime=scan_stamp(fn)[0], attr_proj=attr_proj,
+                                attr_flat=attr_flat, attr_dark=attr_dark, rot_cen=rot_cen, sli=sli,
+                                binning=binning, block_list=block_list, dark_scale=dark_scale,
+                                denoise_flag=denoise_flag, snr=snr, fw_level=fw_level, algorithm=algorithm,
+                                options=options, circ_mask_ratio=circ_mask_ratio, roi=roi, ml_param=ml_param,
+                                auto_block_list=auto_block_list, dtype=np.dtype(dtype).str, preview=preview,
+                                compression=fsave_compression, quantize=fsave_quantize)
+        writer_class = ReconZarrWriter if fsave_format == 'zarr' else ReconH5Writer
+        writer = writer_class(fsave, s1, dtype, roi, fsave_compression, fsave_quantize, meta,
+                              param, fsave_resume)
+        print(f'writing reconstruction to {fsave} ...')
+    try:
+        if writer is not None and writer.is_done():
+            print(f'{fsave} is already complete, skip reconstruction')
+            rec = None
+            if stream_flag:
+                proj0.stop_prefetch()
+        else:
+            rec = recon_img(proj0, angle_list, rot_cen, binning, block_list,
+                            denoise_flag, snr, fw_level, algorithm, options, circ_mask_ratio,
+                            ml_param, auto_block_list, dtype, writer, n_sli, roi)
+    finally:
+        if writer is not None:
+            writer.close()
+    if writer is not None:
         print(f'file saved to {fsave}')
-        print(f'time for saving data: {ts2-ts1:3.2f} sec')        
+    else:
+        if fsave_flag:
+            ts1 = time.time()
+            print('saving data ...')
+            with h5py.File(fsave, "w") as hf:
+                write_recon_img(hf, rec, fsave_compression, fsave_quantize)
+                for key, val in meta.items():
+                    hf.create_dataset(key, data=val)
+            ts2 = time.time()
+            print(f'file saved to {fsave}')
+            print(f'time for saving data: {ts2-ts1:3.2f} sec')
+    if preview > 1:
+        t_preview = time.time() - ts0
+        print(f'preview from 1 in every {preview} projections took {t_preview:3.1f} sec, '
+              f'the full reconstruction (binning = {binning}) is expected to take about {t_preview * preview:3.1f} sec')
     if return_flag:
         return rec, fsave
 
 
 def recon_img(proj0, angle_list, rot_cen, binning=None, block_list=[], denoise_flag=0, snr=0,
-              fw_level=0, algorithm='gridrec', options={}, circ_mask_ratio=0.95, ml_param={}, auto_block_list={}):
+              fw_level=0, algorithm='gridrec', options={}, circ_mask_ratio=0.95, ml_param={}, auto_block_list={},
+              dtype=np.float32, writer=None, n_sli=None, roi=None):
+    '''
+    proj0: normalized projection stack (n_angle, n_row, n_col),
+           or a ProjBlockReader, which is consumed one row block at a time
+    dtype: floating point type used for processing and for the returned reconstruction
+    writer: optional ReconH5Writer. If given, every masked chunk is handed to writer.write()
+            instead of being collected in memory, and None is returned.
+            Chunks already finished in the writer's file (resumed run) are skipped
+    n_sli: number of (binned) slices reconstructed together, chosen by recon_chunk_size() if None.
+           A ProjBlockReader keeps its own block size
+    roi: [r_s, r_e, c_s, c_e] (binned pixels), the slices are cropped to it. With 'gridrec' or 'fbp', only
+         the roi pixels are backprojected, by the numpy FBP engine (recon_util.fbp_recon), so the cost
+         scales with the roi size. Other algorithms reconstruct full slices and crop them
+    'sirt' and 'cgls' run on the cpu (recon_util.iter_recon) with options['num_iter'] iterations,
+    starting from the fbp reconstruction, if the system matrix fits in recon_util.sys_mat_mem (usually only
+    with binning of 4 or more), otherwise 'fbp' is used. 'astra_sirt' falls back to 'sirt' when astra_cuda is not available, or to
+    'gridrec' if the system matrix is too large
+    '''
     ts = time.time()
-    tmp = proj0[0]
-    s = [1, tmp.shape[0], tmp.shape[1]]
-
-
     theta = angle_list / 180.0 * np.pi
     rot_cen = (rot_cen * 1.0) / binning
 
-    img_norm = bin_image_stack(proj0, binning)
-    img_norm = denoise(img_norm, denoise_flag)
-
-    n_angle = len(theta)
-    total_id = np.arange(n_angle)
-
-    block_list_aux = retrieve_auto_block_list(img_norm, auto_block_list)
-
-    idx = set(list(total_id))
-
-    if len(block_list):
-        idx = idx - set(list(block_list))
-
-    if len(block_list_aux):
-        idx = idx - set(list(block_list_aux))
-    idx = np.sort(list(idx))
-    img_norm = img_norm[idx]
-    theta = theta[idx]
-
-    img_norm = ml_denoise(img_norm, ml_param)
-    proj = -np.log(img_norm)
-    proj[np.isnan(proj)] = 0
-    proj[np.isinf(proj)] = 0
-    proj[proj<0] = 0
+    joined = False
+    if isinstance(proj0, ProjBlockReader) and denoise_flag:
+        # the denoise filters work on whole projections (wiener is FFT based), so put the row blocks together
+        proj0 = join_proj_blocks(proj0, binning)
+        joined = True
+    if isinstance(proj0, ProjBlockReader):
+        n_sli = max(1, proj0.n_sli // binning)
+        idx = stream_angle_index(proj0, binning, block_list, auto_block_list)
+        theta = theta[idx]
+        s = (len(idx), proj0.n_row // binning, proj0.n_col // binning)
+        if writer is not None:  # don't even read the row blocks finished in a previous run
+            proj0.skip_rows = {r for r in range(0, proj0.n_row, proj0.n_sli)
+                               if writer.is_done(r // binning, (r + proj0.n_sli) // binning)}
+        proj_blocks = stream_proj_blocks(proj0, idx, binning)
+    else:
+        img_norm = proj0 if joined else bin_image_stack(proj0.astype(dtype, copy=False), binning)
+        img_norm = denoise(img_norm, denoise_flag)
+
+        n_angle = len(theta)
+        total_id = np.arange(n_angle)
+
+        block_list_aux = retrieve_auto_block_list(img_norm, auto_block_list)
+
+        idx = set(list(total_id))
+
+        if len(block_list):
+            idx = idx - set(list(block_list))
+
+        if len(block_list_aux):
+            idx = idx - set(list(block_list_aux))
+        idx = np.sort(list(idx))
+        img_norm = img_norm[idx]
+        theta = theta[idx]
+
+        img_norm = ml_denoise(img_norm, ml_param)
+        proj = neg_log(img_norm, out=img_norm)
+        del img_norm
+        s = proj.shape  # e.g, (600, 1080, 1280)
+        if n_sli is None:
+            n_sli = recon_chunk_size(s[0], s[1], s[2], 1, dtype)
+        if denoise_flag:  # whole pieces of denoise_rows, see preprocess()
+            n_sli = int(np.ceil(n_sli / denoise_rows)) * denoise_rows
+        proj_blocks = iter_proj_blocks(proj, n_sli)
+        del proj
     '''
     if snr > 0:
         print('removing all stripe ...')
@@ -514,7 +591,7 @@ def recon_img(proj0, angle_list, rot_cen, binning=None, block_list=[], denoise_f
     '''
     ts1 = time.time()
 
-    print(f'reconstruction using {algorithm}')
+    print(f'reconstruction using {algorithm}, {n_sli} slices at a time')
     '''
     extra_options = {'MinConstraint': 0, }
     options = {'proj_type': 'cuda',
@@ -523,17 +600,24 @@ def recon_img(proj0, angle_list, rot_cen, binning=None, block_list=[], denoise_f
                'extra_options': extra_options
                }
     '''
-    s = proj.shape  # e.g, (600, 1080, 1280)
-    n_sli = 40
-    n_step = s[1] // n_sli
-    #idx_sli_remain = (n_step * n_sli, s[1])
-    recon = np.zeros((s[1], s[2], s[2]))
-    for i in tqdm(np.arange(n_step + 1), total=n_step):
-        id_s = i * n_sli
-        id_e = min((i + 1) * n_sli, s[1])
-        if id_s >= id_e:
-            break
-        prj_sub = proj[:, id_s: id_e]
+    n_step = int(np.ceil(s[1] / n_sli))
+    if algorithm in ('sirt', 'cgls') and not system_matrix_fits(len(theta), s[2]):
+        print(f'{algorithm} needs a larger binning at {s[2]} columns, switch to fbp')
+        algorithm = 'fbp'
+    roi_fbp = roi is not None and algorithm in ('gridrec', 'fbp')
+    if roi is None:
+        roi = [0, s[2], 0, s[2]]
+    r_s, r_e, c_s, c_e = roi
+    if roi_fbp:
+        print(f'backproject only the roi of {r_e - r_s} x {c_e - c_s} pixels with fbp')
+    recon = None
+    if writer is None:
+        recon = np.zeros((s[1], r_e - r_s, c_e - c_s), dtype=dtype)
+
+    def preprocess(block):
+        id_s, id_e, prj_sub = block
+        if writer is not None and writer.is_done(id_s, id_e):
+            return id_s, id_e, None
         if snr > 0:
             if algotom_exist:
                 print('remove all_stripe using algotom')  
@@ -541,49 +625,206 @@ def recon_img(proj0, angle_list, rot_cen, binning=None, block_list=[], denoise_f
             else:
                 prj_sub = tomopy.prep.stripe.remove_all_stripe(prj_sub, snr=snr)
         if fw_level > 0:
-            prj_sub = tomopy.prep.stripe.remove_stripe_fw(prj_sub, level=fw_level)
-        prj_sub = denoise(prj_sub, denoise_flag)
-        if 'astra' in algorithm:
-            try:
-                rec_sub = tomopy.recon(prj_sub,
-                                         theta,
-                                         center=rot_cen,
-                                         algorithm=tomopy.astra,
-                                         options=options,
-                                         ncore=4)
-            except:
-                rec_sub = tomopy.recon(prj_sub, theta, center=rot_cen, algorithm='gridrec')                
-        else:
-            if algotom_exist:
-                rec_sub = algotom_rec.gridrec_reconstruction(prj_sub, rot_cen, theta, ratio=None, apply_log=False)
-                rec_sub = np.swapaxes(rec_sub, 0, 1)
+            prj_sub = remove_stripe_fw(prj_sub, level=fw_level)
+        if denoise_flag:
+            # in pieces of denoise_rows, as the fixed-size chunks did, so the result does not depend on n_sli
+            prj_sub = np.array(prj_sub, copy=True)
+            for k in range(0, prj_sub.shape[1], denoise_rows):
+                prj_sub[:, k:k + denoise_rows] = denoise(prj_sub[:, k:k + denoise_rows], denoise_flag)
+        return id_s, id_e, prj_sub
+
+    # without astra_cuda, astra_sirt runs sirt on the cpu if its system matrix fits, otherwise gridrec
+    sirt_fits = system_matrix_fits(len(theta), s[2])
+    sys_mat = []  # built on first use and shared by all chunks, also when too large for the cache
+
+    def iter_recon_sub(prj_sub, algorithm, **kw):
+        if len(sys_mat) == 0:
+            sys_mat.append(system_matrix(theta, s[2], rot_cen))
+        return iter_recon(prj_sub, theta, rot_cen, algorithm, n_iter=options.get('num_iter', 20),
+                          sys_mat=sys_mat[0], **kw)
+
+    # the next chunk is read and preprocessed in a background thread while the current one is reconstructed
+    prep_blocks = pipeline(proj_blocks, preprocess, n_ahead=1)
+    try:
+        for id_s, id_e, prj_sub in tqdm(prep_blocks, total=n_step):
+            if prj_sub is None:  # finished in a previous run
+                continue
+            if roi_fbp:
+                rec_sub = circ_mask_roi(fbp_recon(prj_sub, theta, rot_cen, roi=roi), s[2], circ_mask_ratio, roi)
+            elif 'astra' in algorithm:
+                try:
+                    rec_sub = tomopy.recon(prj_sub,
+                                             theta,
+                                             center=rot_cen,
+                                             algorithm=tomopy.astra,
+                                             options=options,
+                                             ncore=4)
+                except:
+                    if algorithm == 'astra_sirt' and sirt_fits:
+                        rec_sub = iter_recon_sub(prj_sub, 'sirt', min_constraint=0)
+                    else:
+                        rec_sub = tomopy.recon(prj_sub, theta, center=rot_cen, algorithm='gridrec')
+            elif algorithm in ('sirt', 'cgls'):
+                rec_sub = iter_recon_sub(prj_sub, algorithm)
+            elif algorithm == 'fbp':
+                rec_sub = fbp_recon(prj_sub, theta, rot_cen)
+            else:
+                if algotom_exist:
+                    rec_sub = algotom_rec.gridrec_reconstruction(prj_sub, rot_cen, theta, ratio=None, apply_log=False)
+                    rec_sub = np.swapaxes(rec_sub, 0, 1)
+                else:
+                    rec_sub = tomopy.recon(prj_sub, theta, center=rot_cen, algorithm='gridrec')
+            if not roi_fbp:
+                rec_sub = tomopy.circ_mask(rec_sub, axis=0, ratio=circ_mask_ratio)[:, r_s:r_e, c_s:c_e]
+            if writer is None:
+                recon[id_s:id_e] = rec_sub
             else:
-                rec_sub = tomopy.recon(prj_sub, theta, center=rot_cen, algorithm='gridrec')
-        recon[id_s:id_e] = rec_sub
-    ts2 = time.time()
-    del img_norm, proj
-    recon = tomopy.circ_mask(recon, axis=0, ratio=circ_mask_ratio)
+                writer.write(id_s, id_e, rec_sub)
+        ts2 = time.time()
+    finally:
+        # also on failure: stop the prep thread, drop its queued blocks and close the reader
+        prep_blocks.close()
+        proj_blocks.close()
+        del proj_blocks
+        if isinstance(proj0, ProjBlockReader):
+            proj0.skip_rows = set()
     print(f'time for loading data:   {ts1 - ts:3.2f} sec')
     print(f'time for reconstruction: {ts2 - ts1:3.2f} sec')
     return recon
 
 
-def algotom_remove_all_strip(prj, snr, la_size=51, sm_size=21, drop_ratio=0.1):
-    s = prj.shape
+def recon_param_str(**param):
+    '''
+    json string of the reconstruction parameters, used to check that a resumed run matches the earlier one
+    '''
+    def to_list(val):
+        if isinstance(val, (np.ndarray, np.generic)):
+            return val.tolist()
+        return str(val)
+    return json.dumps(param, sort_keys=True, default=to_list)
+
+
+def roi_range(roi_cen, roi_size, binning, s):
+    '''
+    [r_s, r_e, c_s, c_e] of the region of interest in reconstructed slices of shape s (binned),
+    roi_cen and roi_size are given in unbinned pixels. Return None if no roi is given
+    '''
+    if not (len(roi_cen) == 2 and len(roi_size) == 2):
+        return None
+    roi_cen = np.array(roi_cen) // binning
+    roi_size = np.array(roi_size) // binning
+    r_s = max(0, int(roi_cen[0]-roi_size[0]/2))
+    r_e = min(s[1], r_s + int(roi_size[0]))
+    c_s = max(0, int(roi_cen[1] - roi_size[1] / 2))
+    c_e = min(s[2], c_s + int(roi_size[1]))
+    return [r_s, r_e, c_s, c_e]
 
+
+def iter_proj_blocks(proj, n_sli=40):
+    for id_s in range(0, proj.shape[1], n_sli):
+        id_e = min(id_s + n_sli, proj.shape[1])
+        yield id_s, id_e, proj[:, id_s:id_e]
+
+
+def iter_binned_blocks(reader, binning=1):
+    '''
+    yield (id_s, id_e, prj) for each row block of reader, binned; id_s and id_e are in unit of binned rows.
+    Blocks of a reader created with the same binning are binned already
+    '''
+    for id_s, id_e, prj in reader:
+        n = (id_e - id_s) // binning
+        if n == 0:
+            continue
+        if reader.binning != binning:
+            prj = bin_image_stack(prj[:, :n * binning], binning)
+        yield id_s // binning, id_s // binning + n, prj
+
+
+def join_proj_blocks(reader, binning=1):
+    '''
+    the whole normalized and binned projection stack of reader, put together from its row blocks
+    '''
+    prj_all = np.empty((reader.n_angle, reader.n_row // binning, reader.n_col // binning), dtype=reader.dtype)
+    for id_s, id_e, prj in iter_binned_blocks(reader, binning):
+        prj_all[:, id_s:id_e] = prj
+    return prj_all
+
+
+def stream_angle_index(reader, binning=1, block_list=[], auto_block_list={}):
+    '''
+    angle index kept for reconstruction when projections are streamed by row blocks.
+    The auto block list needs the intensity sum of every projection, which takes an extra pass over the file
+    '''
+    idx = set(list(np.arange(reader.n_angle)))
+    if len(block_list):
+        idx = idx - set(list(block_list))
+    if len(auto_block_list) and auto_block_list['flag']:
+        img_sum = np.zeros(reader.n_angle)
+        for id_s, id_e, prj in iter_binned_blocks(reader, binning):
+            img_sum += np.sum(prj, axis=(1, 2))
+        block_list_aux = np.where(img_sum < img_sum[0] * auto_block_list['ratio'])[0]
+        idx = idx - set(list(block_list_aux))
+    return np.sort(list(idx))
+
+
+def stream_proj_blocks(reader, idx, binning=1):
+    '''
+    yield (id_s, id_e, proj) for each row block of reader, with binning, angle selection and -log applied.
+    id_s and id_e are in unit of binned rows
+    '''
+    for id_s, id_e, prj in iter_binned_blocks(reader, binning):
+        prj = prj[idx]
+        yield id_s, id_e, neg_log(prj, out=prj)
+
+
+def algotom_remove_all_strip(prj, snr, la_size=51, sm_size=21, drop_ratio=0.1, n_worker=None):
+    '''
+    algotom remove_all_stripe on sinogram prj (n_angle, n_col), or on each row of prj (n_angle, n_row, n_col).
+    For a stack, the rows are split across n_worker processes of the persistent pool (default: all cores),
+    which read prj from and write the result to shared memory. The result is the same as the serial loop
+    '''
+    s = prj.shape
+    param = dict(snr=snr, la_size=la_size, sm_size=sm_size, drop_ratio=drop_ratio)
     if len(s) == 2:
-        prj_r = algotom_prep_removal.remove_all_stripe(prj, snr=snr, la_size=la_size, sm_size=sm_size, drop_ratio=drop_ratio)    
-    else:
-        prj_r = np.zeros(s)
-        for i in range(s[1]):
-            prj_r[:, i] = algotom_prep_removal.remove_all_stripe(prj[:, i], snr=snr, la_size=la_size, sm_size=sm_size, drop_ratio=drop_ratio)    
-    return prj_r
+        return algotom_prep_removal.remove_all_stripe(prj, **param)
+    n_worker = n_worker or cpu_count()
+    parts = split_range(s[1], n_worker)
+    if len(parts) < 2:
+        prj_r = np.zeros(s, dtype=prj.dtype)
+        _remove_all_stripe_rows(prj, prj_r, 0, s[1], param)
+        return prj_r
+    prj_in, fn_in = shared_array(s, prj.dtype)
+    prj_r, fn_out = shared_array(s, prj.dtype)
+    try:
+        prj_in[:] = prj
+        prj_in.flush()
+        args = [(fn_in, fn_out, s, prj.dtype, r_s, r_e, param) for r_s, r_e in parts]
+        get_proc_pool(n_worker).map(_remove_all_stripe_worker, args)
+    finally:
+        del prj_in
+        os.remove(fn_in)
+        os.remove(fn_out)
+    return prj_r.view(np.ndarray)
+
+
+def _remove_all_stripe_rows(prj, prj_r, r_s, r_e, param):
+    for i in range(r_s, r_e):
+        prj_r[:, i] = algotom_prep_removal.remove_all_stripe(prj[:, i], **param)
+
+
+def _remove_all_stripe_worker(args):
+    fn_in, fn_out, shape, dtype, r_s, r_e, param = args
+    prj = np.memmap(fn_in, mode='r', dtype=dtype, shape=shape)
+    prj_r = np.memmap(fn_out, mode='r+', dtype=dtype, shape=shape)
+    _remove_all_stripe_rows(prj, prj_r, r_s, r_e, param)
+    prj_r.flush()
+
 
 def denoise(prj, denoise_flag):
     if denoise_flag == 1:  # Wiener denoise
         ss = prj.shape
         if ss[1] == 1: # single slice
-            prj = np.ones((ss[0], 3, ss[-1])) * prj
+            prj = np.ones((ss[0], 3, ss[-1]), dtype=prj.dtype) * prj
         psf = np.ones([2, 2]) / (2**2)
         reg = None
         balance = 0.3
@@ -594,7 +835,7 @@ def denoise(prj, denoise_flag):
         if ss[1] == 1:
             prj = prj[:, 0:1]
     elif denoise_flag == 2:  # Gaussian denoise
-        prj = gf(prj, [0, 1, 1])
+        prj = gf(prj, [0, 1, 1]).astype(prj.dtype, copy=False)
     return prj
 
 
@@ -0,0 +1,387 @@
+import os
+import threading
+import numpy as np
+import scipy.sparse as sparse
+from collections import OrderedDict
+from prep_util import run_blocks, tile_size
+
+
+fbp_cache = OrderedDict()
+fbp_cache_size = 4
+fbp_cache_lock = threading.Lock()
+fbp_table_mem = 512 * 1024**2  # bytes of backprojection index/weight tables kept per geometry
+sys_mat_cache = OrderedDict()
+sys_mat_cache_size = 2
+sys_mat_cache_mem = 1024**3  # total size of the system matrices kept between reconstructions
+sys_mat_mem = 4 * 1024**3  # largest system matrix (with its transpose) built for iterative reconstruction
+
+
+def ramp_filter(n_pad, filter_name='shepp'):
+    '''
+    ramp filter for rfft of length n_pad, from the band-limited ramp kernel in real space (Kak & Slaney),
+    multiplied by a smoothing window: 'ramlak' / 'none' (no window), 'shepp', 'cosine', 'hann', 'hamming'
+    '''
+    n = np.concatenate((np.arange(1, n_pad // 2 + 1, 2), np.arange(n_pad // 2 - 1, 0, -2)))
+    h = np.zeros(n_pad)
+    h[0] = 0.25
+    h[1::2] = -1 / (np.pi * n) ** 2
+    filt = np.real(np.fft.rfft(h))
+    omega = np.pi * np.fft.rfftfreq(n_pad)[1:] * 2  # 0 .. pi
+    name = str(filter_name).lower()
+    if name == 'shepp':
+        filt[1:] *= np.sin(omega / 2) / (omega / 2)
+    elif name == 'cosine':
+        filt[1:] *= np.cos(omega / 2)
+    elif name == 'hann':
+        filt[1:] *= 0.5 + 0.5 * np.cos(omega)
+    elif name == 'hamming':
+        filt[1:] *= 0.54 + 0.46 * np.cos(omega)
+    elif name not in ('ramlak', 'none'):
+        raise ValueError(f'unknown filter "{filter_name}"')
+    return filt
+
+
+class FBPGeometry:
+    '''
+    Everything filtered backprojection needs for a given (theta, n_col, center, filter, roi), computed once:
+    the ramp filter in frequency domain (with the pi / n_angle scale), the pixels inside the reconstruction
+    circle and, if they take less than fbp_table_mem, the detector index and interpolation weight of every
+    pixel at every angle. Larger geometries keep only cos / sin and the pixel coordinates.
+    With roi = [r_s, r_e, c_s, c_e], only the pixels of rows r_s:r_e and columns c_s:c_e of the n_col x n_col
+    slice are backprojected, so the cost scales with the roi size.
+    Use fbp_geometry() to get a cached one.
+    '''
+    def __init__(self, theta, n_col, center, filter_name='shepp', roi=None):
+        self.theta = np.asarray(theta, dtype=np.float64)
+        self.n_angle = len(self.theta)
+        self.n_col = n_col
+        self.center = float(center)
+        self.n_pad = int(2 ** np.ceil(np.log2(2 * n_col)))
+        self.pad_left = (self.n_pad - n_col) // 2
+        self.filter = (ramp_filter(self.n_pad, filter_name) * np.pi / self.n_angle).astype(np.float32)
+
+        r_s, r_e, c_s, c_e = (0, n_col, 0, n_col) if roi is None else roi
+        self.shape = (r_e - r_s, c_e - c_s)
+        ic = (n_col - 1) / 2
+        row, col = np.mgrid[r_s:r_e, c_s:c_e]
+        inside = (row - ic) ** 2 + (col - ic) ** 2 <= (n_col / 2) ** 2
+        self.pix = np.flatnonzero(inside)
+        self.x = (col.ravel()[self.pix] - ic).astype(np.float32)
+        self.y = (row.ravel()[self.pix] - ic).astype(np.float32)
+        self.cos = np.cos(self.theta).astype(np.float32)
+        self.sin = np.sin(self.theta).astype(np.float32)
+        self.idx = self.weight = None
+        if self.n_angle * len(self.pix) * 8 <= fbp_table_mem:
+            self.idx = np.empty((self.n_angle, len(self.pix)), dtype=np.int32)
+            self.weight = np.empty((self.n_angle, len(self.pix)), dtype=np.float32)
+            for i in range(self.n_angle):
+                self.idx[i], self.weight[i] = self.detector_pos(i, 0, len(self.pix))
+
+    def detector_pos(self, i, p_s, p_e):
+        '''
+        index (in the padded projection) and linear interpolation weight of pixels p_s:p_e at angle i
+        '''
+        t = self.x[p_s:p_e] * self.cos[i] - self.y[p_s:p_e] * self.sin[i]
+        t += np.float32(self.center + self.pad_left)
+        np.clip(t, 0, self.n_pad - 1.001, out=t)
+        idx = t.astype(np.int32)
+        t -= idx
+        return idx, t
+
+    def filter_proj(self, prj):
+        '''
+        edge-padded and ramp-filtered projections, (n_angle, n_sli, n_col) -> (n_angle, n_pad, n_sli) float32
+        '''
+        pad_right = self.n_pad - self.n_col - self.pad_left
+        q = np.empty((self.n_angle, self.n_pad, prj.shape[1]), dtype=np.float32)
+
+        def filter_block(i_s, i_e):
+            p = np.pad(prj[i_s:i_e], ((0, 0), (0, 0), (self.pad_left, pad_right)), mode='edge')
+            f = np.fft.rfft(p, axis=-1)
+            f *= self.filter
+            q[i_s:i_e] = np.fft.irfft(f, n=self.n_pad, axis=-1).transpose(0, 2, 1)
+
+        run_blocks(filter_block, self.n_angle)
+        return q
+
+    def backproject(self, q, n_thread=None):
+        '''
+        backprojection of filtered projections q (n_angle, n_pad, n_sli) onto the pixels inside the circle.
+        Pixels are split in tiles, one per thread at a time; for each angle the n_sli values of every pixel
+        are gathered at once. Returns (n_pix, n_sli)
+        '''
+        n_sli = q.shape[2]
+        n_pix = len(self.pix)
+        rec = np.zeros((n_pix, n_sli), dtype=np.float32)
+        n_tile = max(256, tile_size // 4 // n_sli)
+        q1 = q[:, 1:]  # q1[i, idx] is the right neighbour q[i, idx + 1]
+
+        def bp_block(b_s, b_e):
+            for p_s in range(b_s * n_tile, min(b_e * n_tile, n_pix), n_tile):
+                p_e = min(p_s + n_tile, n_pix)
+                acc = rec[p_s:p_e]
+                v0 = np.empty((p_e - p_s, n_sli), dtype=np.float32)
+                v1 = np.empty_like(v0)
+                for i in range(self.n_angle):
+                    if self.idx is None:
+                        idx, w = self.detector_pos(i, p_s, p_e)
+                    else:
+                        idx, w = self.idx[i, p_s:p_e], self.weight[i, p_s:p_e]
+                    np.take(q[i], idx, axis=0, out=v0)
+                    np.take(q1[i], idx, axis=0, out=v1)
+                    v1 -= v0
+                    v1 *= w[:, np.newaxis]
+                    acc += v0
+                    acc += v1
+
+        run_blocks(bp_block, -(-n_pix // n_tile), n_thread)
+        return rec
+
+    def recon(self, prj, n_thread=None):
+        '''
+        prj: -log projections (n_angle, n_sli, n_col), or a sinogram (n_angle, n_col)
+        Returns (n_sli, n_col, n_col) float32 (or the roi shape), 0 outside the reconstruction circle
+        '''
+        prj = np.asarray(prj, dtype=np.float32)
+        if prj.ndim == 2:
+            prj = prj[:, np.newaxis]
+        n_sli = prj.shape[1]
+        rec = np.zeros((n_sli, self.shape[0] * self.shape[1]), dtype=np.float32)
+        rec[:, self.pix] = self.backproject(self.filter_proj(prj), n_thread).T
+        return rec.reshape((n_sli,) + self.shape)
+
+
+def fbp_geometry(theta, n_col, center, filter_name='shepp', roi=None):
+    '''
+    FBPGeometry of (theta, n_col, center, filter_name, roi), kept in an LRU cache,
+    so chunks, files and repeated calls with the same geometry share it
+    '''
+    theta = np.asarray(theta, dtype=np.float64)
+    key = (theta.tobytes(), int(n_col), float(center), str(filter_name).lower(),
+           None if roi is None else tuple(int(r) for r in roi))
+    with fbp_cache_lock:
+        if key in fbp_cache:
+            fbp_cache.move_to_end(key)
+            return fbp_cache[key]
+    geo = FBPGeometry(theta, n_col, center, filter_name, roi)
+    with fbp_cache_lock:
+        fbp_cache[key] = geo
+        while len(fbp_cache) > fbp_cache_size:
+            fbp_cache.popitem(last=False)
+    return geo
+
+
+def fbp_recon(prj, theta, center, filter_name='shepp', roi=None, n_thread=None):
+    '''
+    filtered backprojection of -log projections prj (n_angle, n_sli, n_col) in float32 with numpy,
+    the same layout as tomopy.recon: returns (n_sli, n_col, n_col).
+    theta in radian, center in pixels of prj. The geometry is cached, see fbp_geometry()
+    roi: [r_s, r_e, c_s, c_e], reconstruct only this part of the slices, returns (n_sli, r_e - r_s, c_e - c_s)
+    '''
+    return fbp_geometry(theta, np.shape(prj)[-1], center, filter_name, roi).recon(prj, n_thread)
+
+
+def circ_mask_roi(rec, n_col, ratio=1, roi=None):
+    '''
+    set pixels of rec (n_sli, n_row, n_col) outside the circle of radius ratio * n_col / 2 to 0, in place,
+    like tomopy.circ_mask. If rec holds only roi = [r_s, r_e, c_s, c_e] of the slices, the circle is still
+    the one of the full n_col x n_col slice
+    '''
+    r_s, r_e, c_s, c_e = (0, n_col, 0, n_col) if roi is None else roi
+    ic = (n_col - 1) / 2
+    y = (np.arange(r_s, r_e) - ic)[:, np.newaxis]
+    x = np.arange(c_s, c_e) - ic
+    rec[:, x * x + y * y >= (ratio * n_col / 2) ** 2] = 0
+    return rec
+
+
+def shift_sino(sino, shift, n_thread=None):
+    '''
+    copies of sinogram sino (n_angle, n_col) shifted along the detector by each value of "shift" (pixels,
+    may be fractional), with a Fourier phase ramp on the edge-padded rows: out[:, k](d) = sino(d + shift[k]).
+    Reconstructing out[:, k] at center c gives the same image as sino at center c + shift[k], so a whole
+    rotation center sweep becomes one multi-slice reconstruction. Returns (n_angle, len(shift), n_col) float32
+    '''
+    sino = np.asarray(sino, dtype=np.float32)
+    shift = np.atleast_1d(np.asarray(shift, dtype=np.float64))
+    n_angle, n_col = sino.shape
+    pad = int(np.ceil(np.max(np.abs(shift)))) + 8
+    n_pad = int(2 ** np.ceil(np.log2(n_col + 2 * pad)))
+    pad_left = (n_pad - n_col) // 2
+    f = np.fft.rfft(np.pad(sino, ((0, 0), (pad_left, n_pad - n_col - pad_left)), mode='edge'), axis=-1)
+    k = np.fft.rfftfreq(n_pad)
+    out = np.empty((n_angle, len(shift), n_col), dtype=np.float32)
+
+    def shift_block(i_s, i_e):
+        for i in range(i_s, i_e):
+            ramp = np.exp(2j * np.pi * k * shift[i]).astype(np.complex64)
+            out[:, i] = np.fft.irfft(f * ramp, n=n_pad, axis=-1)[:, pad_left:pad_left + n_col]
+
+    run_blocks(shift_block, len(shift), n_thread)
+    return out
+
+
+class SystemMatrix:
+    '''
+    Sparse projection matrix A of the pixels inside the reconstruction circle, for (theta, n_col, center):
+    a ray (angle i, detector column d) is row i * n_col + d, and each pixel adds to the two columns next to its
+    projected position with linear interpolation weights, the same geometry as FBPGeometry.
+    A and its transpose are stored in CSR row blocks, so forward and back projection are split across threads
+    (scipy releases the GIL in sparse products). Use system_matrix() to get a cached one.
+    '''
+    def __init__(self, theta, n_col, center, n_thread=None):
+        theta = np.asarray(theta, dtype=np.float64)
+        self.n_col = n_col
+        self.n_angle = len(theta)
+        ic = (n_col - 1) / 2
+        row, col = np.mgrid[0:n_col, 0:n_col]
+        self.pix = np.flatnonzero((row - ic) ** 2 + (col - ic) ** 2 <= (n_col / 2) ** 2)
+        x = (col.ravel()[self.pix] - ic).astype(np.float32)
+        y = (row.ravel()[self.pix] - ic).astype(np.float32)
+        n_pix = len(self.pix)
+        n_byte = system_matrix_bytes(self.n_angle, n_col)
+        self.nbytes = n_byte
+        if n_byte > sys_mat_mem:
+            raise ValueError(f'system matrix of {self.n_angle} angles x {n_col} columns needs {n_byte / 1024**3:.1f} GB '
+                             f'(limit sys_mat_mem = {sys_mat_mem / 1024**3:.1f} GB), use a larger binning')
+        rows, cols, vals = [], [], []
+        p = np.arange(n_pix, dtype=np.int32)
+        for i in range(self.n_angle):
+            t = x * np.float32(np.cos(theta[i])) - y * np.float32(np.sin(theta[i])) + np.float32(center)
+            idx = np.floor(t).astype(np.int32)
+            w = t - idx
+            for d, v in ((idx, 1 - w), (idx + 1, w)):
+                keep = (d >= 0) & (d < n_col) & (v > 0)
+                rows.append(d[keep] + i * n_col)
+                cols.append(p[keep])
+                vals.append(v[keep])
+        shape = (self.n_angle * n_col, n_pix)
+        A = sparse.csr_matrix((np.concatenate(vals), (np.concatenate(rows), np.concatenate(cols))),
+                              shape=shape, dtype=np.float32)
+        n_thread = n_thread or os.cpu_count() or 1
+        self.n_thread = n_thread
+        self.A = self.row_blocks(A, n_thread)
+        self.AT = self.row_blocks(A.T.tocsr(), n_thread)
+        row_sum = np.asarray(A.sum(axis=1)).ravel()
+        col_sum = np.asarray(A.sum(axis=0)).ravel()
+        self.inv_row_sum = np.divide(1, row_sum, out=np.zeros_like(row_sum), where=row_sum > 0)[:, np.newaxis]
+        self.inv_col_sum = np.divide(1, col_sum, out=np.zeros_like(col_sum), where=col_sum > 0)[:, np.newaxis]
+
+    @staticmethod
+    def row_blocks(M, n_block):
+        bound = np.linspace(0, M.shape[0], min(n_block, M.shape[0]) + 1).astype(int)
+        return [(bound[i], bound[i + 1], M[bound[i]:bound[i + 1]]) for i in range(len(bound) - 1)]
+
+    def dot(self, blocks, x, n_row):
+        out = np.empty((n_row, x.shape[1]), dtype=np.float32)
+
+        def dot_block(b_s, b_e):
+            for r_s, r_e, M in blocks[b_s:b_e]:
+                out[r_s:r_e] = M @ x
+        run_blocks(dot_block, len(blocks), self.n_thread)
+        return out
+
+    def forward(self, x):
+        '''
+        projections of pixel values x (n_pix, n_sli) -> (n_angle * n_col, n_sli)
+        '''
+        return self.dot(self.A, x, self.n_angle * self.n_col)
+
+    def back(self, y):
+        '''
+        backprojection (transpose) of y (n_angle * n_col, n_sli) -> (n_pix, n_sli)
+        '''
+        return self.dot(self.AT, y, len(self.pix))
+
+
+def system_matrix_bytes(n_angle, n_col):
+    '''
+    memory taken by the SystemMatrix of n_angle projections of n_col columns (with its transpose)
+    '''
+    ic = (n_col - 1) / 2
+    r = np.arange(n_col) - ic
+    n_pix = int(np.count_nonzero(r[:, np.newaxis] ** 2 + r ** 2 <= (n_col / 2) ** 2))
+    return n_angle * n_pix * 2 * 8 * 2
+
+
+def system_matrix_fits(n_angle, n_col):
+    '''
+    True if the SystemMatrix of n_angle x n_col projections stays within sys_mat_mem, so sirt / cgls can run
+    '''
+    return system_matrix_bytes(n_angle, n_col) <= sys_mat_mem
+
+
+def system_matrix(theta, n_col, center, n_thread=None):
+    '''
+    SystemMatrix of (theta, n_col, center), kept in an LRU cache so chunks and files with the same geometry share it.
+    The cache holds at most sys_mat_cache_size matrices and sys_mat_cache_mem bytes; larger matrices are not
+    cached, keep a reference (see iter_recon(sys_mat=...)) to reuse them
+    '''
+    theta = np.asarray(theta, dtype=np.float64)
+    key = (theta.tobytes(), int(n_col), float(center))
+    with fbp_cache_lock:
+        if key in sys_mat_cache:
+            sys_mat_cache.move_to_end(key)
+            return sys_mat_cache[key]
+    A = SystemMatrix(theta, n_col, center, n_thread)
+    if A.nbytes > sys_mat_cache_mem:
+        return A
+    with fbp_cache_lock:
+        sys_mat_cache[key] = A
+        while (len(sys_mat_cache) > sys_mat_cache_size
+               or sum(a.nbytes for a in sys_mat_cache.values()) > sys_mat_cache_mem):
+            sys_mat_cache.popitem(last=False)
+    return A
+
+
+def clear_system_matrix_cache():
+    with fbp_cache_lock:
+        sys_mat_cache.clear()
+
+
+def iter_recon(prj, theta, center, algorithm='sirt', n_iter=20, warm_start=True, min_constraint=None,
+               n_thread=None, sys_mat=None):
+    '''
+    SIRT or CGLS reconstruction of -log projections prj (n_angle, n_sli, n_col) on the CPU, all slices at once,
+    with the cached sparse system matrix. Returns (n_sli, n_col, n_col) float32, like tomopy.recon.
+    warm_start: start from the fbp reconstruction instead of 0, so far fewer iterations are needed
+    min_constraint: lower bound applied after every SIRT iteration, e.g. 0 (not used by CGLS)
+    sys_mat: SystemMatrix of (theta, n_col, center) to use, e.g. one kept for all chunks of a volume.
+    Raises ValueError if the system matrix would exceed sys_mat_mem, check with system_matrix_fits()
+    '''
+    prj = np.asarray(prj, dtype=np.float32)
+    if prj.ndim == 2:
+        prj = prj[:, np.newaxis]
+    n_angle, n_sli, n_col = prj.shape
+    A = system_matrix(theta, n_col, center, n_thread) if sys_mat is None else sys_mat
+    b = np.ascontiguousarray(prj.transpose(0, 2, 1)).reshape(n_angle * n_col, n_sli)
+    if warm_start:
+        x = fbp_recon(prj, theta, center, n_thread=n_thread).reshape(n_sli, -1)[:, A.pix].T.copy()
+    else:
+        x = np.zeros((len(A.pix), n_sli), dtype=np.float32)
+    if algorithm == 'sirt':
+        for i in range(n_iter):
+            r = b - A.forward(x)
+            r *= A.inv_row_sum
+            x += A.inv_col_sum * A.back(r)
+            if min_constraint is not None:
+                np.maximum(x, min_constraint, out=x)
+    elif algorithm == 'cgls':
+        r = b - A.forward(x)
+        p = A.back(r)
+        gamma = np.sum(p * p, axis=0)
+        for i in range(n_iter):
+            q = A.forward(p)
+            alpha = np.divide(gamma, np.sum(q * q, axis=0), out=np.zeros_like(gamma), where=gamma > 0)
+            x += alpha * p
+            r -= alpha * q
+            s = A.back(r)
+            gamma_new = np.sum(s * s, axis=0)
+            beta = np.divide(gamma_new, gamma, out=np.zeros_like(gamma), where=gamma > 0)
+            p = s + beta * p
+            gamma = gamma_new
+    else:
+        raise ValueError(f'unknown algorithm "{algorithm}", use "sirt" or "cgls"')
+    rec = np.zeros((n_sli, n_col * n_col), dtype=np.float32)
+    rec[:, A.pix] = x.T
+    return rec.reshape(n_sli, n_col, n_col)